@@ -4,6 +4,11 @@ from trytond.pool import Pool
 from . import work
 from . import configuration
 from . import invoice
+from . import product
+from . import purchase
+from . import stock
+from . import summary
+from . import timesheet
 
 
 def register():
@@ -11,7 +16,34 @@ def register():
         configuration.Configuration,
         configuration.ConfigurationCompany,
         work.Project,
-        work.ProjectSaleLine,
+        work.ProjectExportFinancialsStart,
         work.Sale,
+        work.SaleLine,
+        work.ProjectSaleLine,
+        invoice.Invoice,
         invoice.InvoiceLine,
+        stock.Move,
+        product.Template,
+        product.ProductCostPrice,
+        timesheet.Work,
+        timesheet.TimesheetLine,
+        summary.ProjectSummary,
+        summary.ProjectSummaryRun,
+        summary.ProjectPeriodSummary,
+        summary.ProjectPeriodSummaryContext,
         module='work_project', type_='model')
+    Pool.register(
+        work.ProjectExportFinancials,
+        module='work_project', type_='wizard')
+    Pool.register(
+        work.ProjectFinancialsReport,
+        module='work_project', type_='report')
+    Pool.register(
+        purchase.Project,
+        module='work_project', type_='model',
+        depends=['sale_opportunity_purchase_relation'])
+    Pool.register(
+        purchase.ProjectOpenPurchases,
+        purchase.ProjectOpenPurchaseInvoices,
+        module='work_project', type_='wizard',
+        depends=['sale_opportunity_purchase_relation'])
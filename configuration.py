@@ -1,5 +1,6 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import Model, ModelSQL, ModelView, ModelSingleton, fields
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
@@ -26,20 +27,13 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         CompanyConfig = pool.get('work.project.configuration.company')
 
         company_id = Transaction().context.get('company')
-        company_configs = CompanyConfig.search([
-                ('company', '=', company_id),
-                ])
+        values = CompanyConfig.get_values(company_id)
 
         res = {}
         for fname in names:
             res[fname] = {
-                configs[0].id: None,
+                configs[0].id: values.get(fname),
                 }
-            if company_configs:
-                val = getattr(company_configs[0], fname)
-                if isinstance(val, Model):
-                    val = val.id
-                res[fname][configs[0].id] = val
         return res
 
     @classmethod
@@ -70,3 +64,49 @@ class ConfigurationCompany(ModelSQL):
         domain=[
             ('code', '=', 'work.project'),
             ])
+
+    _values_cache = Cache('work_project_configuration_company.get_values',
+        context=False)
+
+    @classmethod
+    def get_values(cls, company_id):
+        '''
+        Returns a dictionary with the configuration values of the company.
+        It is cached until a company configuration is modified.
+        '''
+        values = cls._values_cache.get(company_id)
+        if values is not None:
+            return values
+
+        Configuration = Pool().get('work.project.configuration')
+        values = {}
+        company_configs = cls.search([
+                ('company', '=', company_id),
+                ], limit=1)
+        if company_configs:
+            company_config, = company_configs
+            for fname, field in Configuration._fields.iteritems():
+                if getattr(field, 'getter', None) != 'get_company_config':
+                    continue
+                val = getattr(company_config, fname)
+                if isinstance(val, Model):
+                    val = val.id
+                values[fname] = val
+        cls._values_cache.set(company_id, values)
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        company_configs = super(ConfigurationCompany, cls).create(vlist)
+        cls._values_cache.clear()
+        return company_configs
+
+    @classmethod
+    def write(cls, *args):
+        super(ConfigurationCompany, cls).write(*args)
+        cls._values_cache.clear()
+
+    @classmethod
+    def delete(cls, company_configs):
+        super(ConfigurationCompany, cls).delete(company_configs)
+        cls._values_cache.clear()
@@ -0,0 +1,136 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Opt-in profiling of the work_project getters and searchers.
+
+It is enabled in the configuration file of trytond with::
+
+    [work_project]
+    profile = True
+
+Each call of a profiled method is then logged with its wall time, the
+number of SQL queries it executed, the number of records it processed and
+the number of cache hits reported with cache_hits.
+'''
+import logging
+import threading
+import time
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['profile', 'cache_hits', 'QueryCounter']
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+def _enabled():
+    return config.getboolean('work_project', 'profile', default=False)
+
+
+class _Frame(object):
+    'The counters of a profiled call'
+
+    def __init__(self):
+        self.queries = 0
+        self.cache_hits = 0
+
+
+class _CountingConnection(object):
+
+    def __init__(self, connection, frames):
+        self._connection = connection
+        self._frames = frames
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._frames)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, frames):
+        self._cursor = cursor
+        self._frames = frames
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        # The queries of nested calls are also counted by the callers
+        for frame in self._frames:
+            frame.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+
+def _get_frames():
+    if not hasattr(_local, 'frames'):
+        _local.frames = []
+    return _local.frames
+
+
+class QueryCounter(object):
+    '''
+    Count the queries executed on the transaction and the cache hits
+    reported within the block into the returned frame.
+    '''
+
+    def __enter__(self):
+        transaction = Transaction()
+        frames = _get_frames()
+        self.frame = _Frame()
+        if not frames:
+            self._connection = transaction.connection
+            transaction.connection = _CountingConnection(
+                self._connection, frames)
+        frames.append(self.frame)
+        return self.frame
+
+    def __exit__(self, type, value, traceback):
+        frames = _get_frames()
+        frames.pop()
+        if not frames:
+            Transaction().connection = self._connection
+
+
+def cache_hits(count=1):
+    'Report count cache hits to the profiled calls in progress'
+    for frame in getattr(_local, 'frames', []):
+        frame.cache_hits += count
+
+
+def profile(func):
+    '''
+    Decorate a getter or searcher of a Model to log its profile when the
+    profiling is enabled. The first argument is the class or the instance.
+    '''
+    if not _enabled():
+        return func
+
+    @wraps(func)
+    def wrapper(self_or_cls, *args, **kwargs):
+        start = time.time()
+        with QueryCounter() as frame:
+            try:
+                return func(self_or_cls, *args, **kwargs)
+            finally:
+                duration = time.time() - start
+                if not isinstance(self_or_cls, type):
+                    records = 1
+                elif args and isinstance(args[0], (list, tuple)):
+                    records = len(args[0])
+                else:
+                    records = None
+                logger.info('%s.%s: %.2f ms, %s queries, %s records, '
+                    '%s cache hits', self_or_cls.__name__, func.__name__,
+                    duration * 1000, frame.queries, records,
+                    frame.cache_hits)
+    return wrapper
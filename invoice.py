@@ -1,11 +1,53 @@
 # -*- encoding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from sql import Null
+
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
+
+__all__ = ['Invoice', 'InvoiceLine']
+
+
+class Invoice:
+    __name__ = 'account.invoice'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def _get_work_projects(cls, invoices):
+        'Returns the ids of the projects of the lines of the invoices'
+        InvoiceLine = Pool().get('account.invoice.line')
+        cursor = Transaction().connection.cursor()
+        line = InvoiceLine.__table__()
+
+        projects = set()
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            cursor.execute(*line.select(line.work_project,
+                    where=reduce_ids(line.invoice, sub_ids)
+                    & (line.work_project != Null),
+                    group_by=line.work_project))
+            projects.update(p for p, in cursor.fetchall())
+        return projects
 
-__all__ = ['InvoiceLine']
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        all_invoices = []
+        for invoices, _ in zip(actions, actions):
+            all_invoices.extend(invoices)
+        super(Invoice, cls).write(*args)
+        Summary.refresh(cls._get_work_projects(all_invoices))
+
+    @classmethod
+    def delete(cls, invoices):
+        Summary = Pool().get('work.project.summary')
+        projects = cls._get_work_projects(invoices)
+        super(Invoice, cls).delete(invoices)
+        Summary.refresh(projects)
 
 
 class InvoiceLine:
@@ -14,6 +56,68 @@ class InvoiceLine:
 
     work_project = fields.Many2One('work.project', 'Work Project',
         states={
-            'invisible': ~Eval('_parent_invoice', {}).get('type', Eval('invoice_type')).in_(['in_invoice', 'in_credit_note']),
+            'invisible': Eval('_parent_invoice', {}).get('type',
+                Eval('invoice_type')) != 'in',
             },
-        depends=[])
+        depends=['invoice_type'])
+
+    @classmethod
+    def _get_work_projects(cls, lines):
+        '''
+        Returns the ids of the projects of the invoice lines, which are set
+        on the supplier lines and on the lines originated by sale lines.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        projects = set()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            cursor.execute(*table.select(table.work_project,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.work_project != Null),
+                    group_by=table.work_project))
+            projects.update(p for p, in cursor.fetchall())
+        return projects
+
+    @classmethod
+    def __register__(cls, module_name):
+        SaleLine = Pool().get('sale.line')
+        super(InvoiceLine, cls).__register__(module_name)
+        SaleLine._update_origin_work_project(cls)
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Summary = pool.get('work.project.summary')
+        SaleLine = pool.get('sale.line')
+        lines = super(InvoiceLine, cls).create(vlist)
+        SaleLine._update_origin_work_project(cls, ids=[l.id for l in lines])
+        Summary.refresh(cls._get_work_projects(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Summary = pool.get('work.project.summary')
+        SaleLine = pool.get('sale.line')
+        actions = iter(args)
+        all_lines = []
+        to_update = []
+        for lines, values in zip(actions, actions):
+            all_lines.extend(lines)
+            if 'origin' in values:
+                to_update.extend(lines)
+        projects = cls._get_work_projects(all_lines)
+        super(InvoiceLine, cls).write(*args)
+        if to_update:
+            SaleLine._update_origin_work_project(cls,
+                ids=[l.id for l in to_update])
+        projects |= cls._get_work_projects(all_lines)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, lines):
+        Summary = Pool().get('work.project.summary')
+        projects = cls._get_work_projects(lines)
+        super(InvoiceLine, cls).delete(lines)
+        Summary.refresh(projects)
@@ -0,0 +1,90 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Null
+
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
+
+__all__ = ['Template', 'ProductCostPrice']
+
+
+def _get_product_work_projects(ids, column='id'):
+    '''
+    Returns the ids of the projects with sale lines of the products whose
+    column is in ids.
+    '''
+    pool = Pool()
+    SaleLine = pool.get('sale.line')
+    Product = pool.get('product.product')
+    cursor = Transaction().connection.cursor()
+    line = SaleLine.__table__()
+    product = Product.__table__()
+
+    projects = set()
+    for sub_ids in grouped_slice(list(ids)):
+        cursor.execute(*line.join(product,
+                condition=product.id == line.product
+                ).select(line.work_project,
+                where=reduce_ids(getattr(product, column), sub_ids)
+                & (line.work_project != Null),
+                group_by=line.work_project))
+        projects.update(p for p, in cursor.fetchall())
+    return projects
+
+
+class Template:
+    __name__ = 'product.template'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        to_refresh = []
+        for templates, values in zip(actions, actions):
+            # The type classifies the sale lines of the projects
+            if 'type' in values:
+                to_refresh.extend(templates)
+        super(Template, cls).write(*args)
+        if to_refresh:
+            Summary.refresh(_get_product_work_projects(
+                    [t.id for t in to_refresh], column='template'))
+
+
+class ProductCostPrice:
+    __name__ = 'product.cost_price'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def _get_work_projects(cls, cost_prices):
+        'Returns the ids of the projects with sale lines of the products'
+        return _get_product_work_projects(set(c.product.id
+                for c in cls.browse([c.id for c in cost_prices])
+                if c.product))
+
+    @classmethod
+    def create(cls, vlist):
+        Summary = Pool().get('work.project.summary')
+        cost_prices = super(ProductCostPrice, cls).create(vlist)
+        Summary.refresh(cls._get_work_projects(cost_prices))
+        return cost_prices
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        all_cost_prices = []
+        for cost_prices, _ in zip(actions, actions):
+            all_cost_prices.extend(cost_prices)
+        projects = cls._get_work_projects(all_cost_prices)
+        super(ProductCostPrice, cls).write(*args)
+        projects |= cls._get_work_projects(all_cost_prices)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, cost_prices):
+        Summary = Pool().get('work.project.summary')
+        projects = cls._get_work_projects(cost_prices)
+        super(ProductCostPrice, cls).delete(cost_prices)
+        Summary.refresh(projects)
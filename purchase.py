@@ -0,0 +1,130 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Column, Null
+from sql.operators import Concat
+
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import PYSONEncoder
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.wizard import Wizard, StateAction
+
+from .instrumentation import profile
+
+__all__ = ['Project', 'ProjectOpenPurchases', 'ProjectOpenPurchaseInvoices']
+
+
+class Project:
+    __name__ = 'work.project'
+    __metaclass__ = PoolMeta
+    purchases = fields.Function(fields.One2Many('purchase.purchase', None,
+            'Purchases'),
+        'get_purchase_relations', searcher='search_purchase_relations')
+    purchase_invoices = fields.Function(fields.One2Many('account.invoice',
+            None, 'Purchase Invoices'),
+        'get_purchase_relations', searcher='search_purchase_relations')
+
+    @classmethod
+    def _get_purchase_relation_query(cls, name):
+        '''
+        Returns a query with the project and the id of the records of the
+        purchase relation name: purchases or purchase_invoices.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        PurchaseLine = pool.get('purchase.line')
+        InvoiceLine = pool.get('account.invoice.line')
+        sale_line = SaleLine.__table__()
+        purchase_line = PurchaseLine.__table__()
+        invoice_line = InvoiceLine.__table__()
+
+        field = PurchaseLine._fields['sale_lines']
+        if field._type == 'many2many':
+            Relation = pool.get(field.relation_name)
+            relation = Relation.__table__()
+            lines = purchase_line.join(relation,
+                condition=Column(relation, field.origin) == purchase_line.id
+                ).join(sale_line,
+                condition=sale_line.id == Column(relation, field.target))
+        else:
+            lines = purchase_line.join(sale_line,
+                condition=Column(sale_line, field.field) == purchase_line.id)
+        where = sale_line.work_project != Null
+
+        if name == 'purchases':
+            return lines.select(sale_line.work_project.as_('project'),
+                purchase_line.purchase.as_('id'),
+                where=where)
+        return lines.join(invoice_line,
+            condition=invoice_line.origin == Concat(
+                PurchaseLine.__name__ + ',', purchase_line.id)
+            ).select(sale_line.work_project.as_('project'),
+            invoice_line.invoice.as_('id'),
+            where=where & (invoice_line.invoice != Null))
+
+    @classmethod
+    @profile
+    def get_purchase_relations(cls, projects, names):
+        cursor = Transaction().connection.cursor()
+        ids = [p.id for p in projects]
+        res = {}
+        for name in names:
+            res[name] = values = dict((i, []) for i in ids)
+            query = cls._get_purchase_relation_query(name)
+            for sub_ids in grouped_slice(ids):
+                # Group to remove the duplicates of records shared by lines
+                cursor.execute(*query.select(query.project, query.id,
+                        where=reduce_ids(query.project, sub_ids),
+                        group_by=[query.project, query.id],
+                        order_by=[query.project, query.id]))
+                for project_id, record_id in cursor.fetchall():
+                    values[project_id].append(record_id)
+        return res
+
+    @classmethod
+    @profile
+    def search_purchase_relations(cls, name, clause):
+        pool = Pool()
+        Target = pool.get(cls._fields[name].model_name)
+        _, operator, value = clause[:3]
+        nested = clause[0][len(name) + 1:]
+        if not nested:
+            nested = 'rec_name' if isinstance(value, basestring) else 'id'
+        targets = Target.search([(nested,) + tuple(clause[1:])], order=[],
+            query=True)
+        query = cls._get_purchase_relation_query(name)
+        return [('id', 'in', query.select(query.project,
+                    where=query.id.in_(targets)))]
+
+
+class ProjectOpenPurchases(Wizard):
+    'Open Project Purchases'
+    __name__ = 'work.project.open_purchases'
+    start_state = 'open_'
+    open_ = StateAction('purchase.act_purchase_form')
+
+    @classmethod
+    def get_domain(cls, project_ids):
+        'Returns the domain of the records related to the projects'
+        return [('lines.sale_lines.work_project', 'in', project_ids)]
+
+    def do_open_(self, action):
+        # Filter on the projects to keep the domain small
+        action['pyson_domain'] = PYSONEncoder().encode(self.get_domain(
+                Transaction().context.get('active_ids', [])))
+        return action, {}
+
+    def transition_open_(self):
+        return 'end'
+
+
+class ProjectOpenPurchaseInvoices(ProjectOpenPurchases):
+    'Open Project Purchase Invoices'
+    __name__ = 'work.project.open_purchase_invoices'
+    open_ = StateAction('account_invoice.act_invoice_in_form')
+
+    @classmethod
+    def get_domain(cls, project_ids):
+        return [('lines.origin.sale_lines.work_project', 'in', project_ids,
+                'purchase.line')]
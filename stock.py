@@ -0,0 +1,39 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Move']
+
+
+class Move:
+    __name__ = 'stock.move'
+    __metaclass__ = PoolMeta
+    work_project = fields.Many2One('work.project', 'Work Project',
+        readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        SaleLine = Pool().get('sale.line')
+        super(Move, cls).__register__(module_name)
+        SaleLine._update_origin_work_project(cls)
+
+    @classmethod
+    def create(cls, vlist):
+        SaleLine = Pool().get('sale.line')
+        moves = super(Move, cls).create(vlist)
+        SaleLine._update_origin_work_project(cls, ids=[m.id for m in moves])
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        SaleLine = Pool().get('sale.line')
+        actions = iter(args)
+        to_update = []
+        for moves, values in zip(actions, actions):
+            if 'origin' in values:
+                to_update.extend(moves)
+        super(Move, cls).write(*args)
+        if to_update:
+            SaleLine._update_origin_work_project(cls,
+                ids=[m.id for m in to_update])
@@ -0,0 +1,505 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import logging
+import time
+from decimal import Decimal
+from sql import Column, Literal, Null, Union
+from sql.aggregate import Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs, Extract, Round, Sign
+from sql.operators import Mod, NotIn
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+
+from .instrumentation import cache_hits
+from .work import SUMMARY_FIELDS
+
+__all__ = ['ProjectSummary', 'ProjectSummaryRun', 'ProjectPeriodSummary',
+    'ProjectPeriodSummaryContext']
+
+logger = logging.getLogger(__name__)
+# Sale lines, supplier invoice lines and timesheet lines
+_PERIOD_SOURCES = 3
+
+
+def _round_currency(amount, rounding):
+    '''
+    Returns the expression of the amount rounded to the rounding of the
+    currency, half to even as Currency.round does.
+    '''
+    value = amount / rounding
+    rounded = Round(value)
+    # Round goes half away from zero so the odd ties are moved back
+    return Case(((Abs(rounded - value) == 0.5) & (Mod(rounded, 2) != 0),
+            rounded - Sign(value)),
+        else_=rounded) * rounding
+
+
+class ProjectSummary(ModelSQL):
+    'Work Project Summary'
+    __name__ = 'work.project.summary'
+    project = fields.Many2One('work.project', 'Project', required=True,
+        select=True, ondelete='CASCADE')
+    income_labor = fields.Numeric('Income Labor')
+    income_material = fields.Numeric('Income Material')
+    income_other = fields.Numeric('Income Other')
+    expense_labor = fields.Numeric('Expense Labor')
+    expense_material = fields.Numeric('Expense Material')
+    expense_other = fields.Numeric('Expense Other')
+    margin_labor = fields.Numeric('Margin Labor')
+    margin_material = fields.Numeric('Margin Material')
+    margin_other = fields.Numeric('Margin Other')
+    margin_percent_labor = fields.Numeric('Margin (%) Labor')
+    margin_percent_material = fields.Numeric('Margin (%) Material')
+    margin_percent_other = fields.Numeric('Margin (%) Other')
+    invoiced_amount = fields.Numeric('Invoiced Amount')
+    amount_to_invoice = fields.Numeric('Amount To Invoice')
+    compute_date = fields.Timestamp('Compute Date', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProjectSummary, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('project_uniq', Unique(t, t.project),
+                'There can be only one summary per project.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(ProjectSummary, cls).__register__(module_name)
+        # The searchers and orders of the figures read only the summaries
+        cls.fill(skip_errors=True)
+
+    @classmethod
+    def get_amounts(cls, projects):
+        '''
+        Returns a dictionary with the stored financial figures of each
+        project. Projects without summary or restricted to dates by the
+        context are computed live.
+        '''
+        pool = Pool()
+        Project = pool.get('work.project')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if (transaction.context.get('from_date')
+                or transaction.context.get('to_date')):
+            return Project._compute_amounts(Project.browse(projects))
+
+        amounts = {}
+        columns = [Column(table, name) for name in SUMMARY_FIELDS]
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            cursor.execute(*table.select(table.project, *columns,
+                    where=reduce_ids(table.project, sub_ids)))
+            for row in cursor.fetchall():
+                amounts[row[0]] = dict((name, Decimal(str(value or 0)))
+                    for name, value in zip(SUMMARY_FIELDS, row[1:]))
+        cache_hits(len(amounts))
+        missing = [p for p in projects if p.id not in amounts]
+        if missing:
+            amounts.update(Project._compute_amounts(Project.browse(missing)))
+        return amounts
+
+    @classmethod
+    def refresh(cls, projects):
+        '''
+        Recompute and store the summary of the projects.
+        The summary of the closed projects is kept as their final figures.
+
+        It is called when the sales, sale lines, supplier invoices, timesheet
+        lines or company of the projects change and when the cost price or
+        the type of their sold products change.
+        The changes of the currency rates are tolerated: the amounts
+        converted with them are recomputed by the rebuild and the recompute
+        metrics crons.
+        '''
+        pool = Pool()
+        Project = pool.get('work.project')
+
+        project_ids = sorted(set(int(p) for p in projects))
+        if not project_ids:
+            return
+        # Skip the projects deleted in the same transaction
+        projects = Project.search([
+                ('id', 'in', project_ids),
+                ('state', '=', 'open'),
+                ])
+        cls._store(projects)
+
+    @classmethod
+    def fill(cls, skip_errors=False):
+        '''
+        Compute and store the summary of the projects without one, including
+        the closed projects.
+        If skip_errors is set, the projects which can not be computed, for
+        example for lack of a currency rate, are logged and left without
+        summary for the rebuild.
+        '''
+        pool = Pool()
+        Project = pool.get('work.project')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        project = Project.__table__()
+
+        cursor.execute(*project.select(project.id,
+                where=NotIn(project.id, table.select(table.project))))
+        for sub_ids in grouped_slice([i for i, in cursor.fetchall()]):
+            projects = Project.browse(list(sub_ids))
+            if not skip_errors:
+                cls._store(projects)
+                continue
+            # The figures are computed before anything is stored
+            try:
+                cls._store(projects)
+            except UserError:
+                for project in projects:
+                    try:
+                        cls._store([project])
+                    except UserError as exception:
+                        logger.warning('The summary of project %s is not '
+                            'computed: %s', project.id, exception.message)
+    @classmethod
+    def _store(cls, projects):
+        'Compute and store the summary of the projects'
+        pool = Pool()
+        Project = pool.get('work.project')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if not projects:
+            return
+        # The summary stores the figures of all dates
+        with Transaction().set_context(from_date=None, to_date=None):
+            amounts = Project._compute_amounts(projects)
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.project, sub_ids)))
+        now = datetime.datetime.now()
+        to_create = []
+        for project in projects:
+            values = amounts[project.id].copy()
+            values['project'] = project.id
+            values['compute_date'] = now
+            to_create.append(values)
+        cls.create(to_create)
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Recompute the summary of every open project and of the closed
+        projects without one.
+        '''
+        pool = Pool()
+        Project = pool.get('work.project')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        project = Project.__table__()
+
+        cursor.execute(*table.delete(
+                where=table.project.in_(project.select(project.id,
+                        where=project.state == 'open'))))
+        cls.fill()
+
+
+class ProjectSummaryRun(ModelSQL, ModelView):
+    'Work Project Summary Run'
+    __name__ = 'work.project.summary.run'
+    cutoff = fields.Timestamp('Cutoff', readonly=True,
+        help='The open projects computed before are recomputed.')
+    end = fields.Timestamp('End', readonly=True)
+    chunks = fields.Integer('Chunks', readonly=True)
+    projects = fields.Integer('Projects', readonly=True)
+    duration = fields.Float('Duration', readonly=True,
+        help='The time spent recomputing the chunks in seconds.')
+
+    @classmethod
+    def __setup__(cls):
+        super(ProjectSummaryRun, cls).__setup__()
+        cls._order.insert(0, ('cutoff', 'DESC'))
+
+    @staticmethod
+    def default_chunks():
+        return 0
+
+    @staticmethod
+    def default_projects():
+        return 0
+
+    @staticmethod
+    def default_duration():
+        return 0.
+
+    @classmethod
+    def get_current(cls):
+        '''
+        Returns the unfinished run to resume or a new one.
+        It must be called at the start of a transaction as the transaction is
+        rolled back while the run table is locked by another worker.
+        '''
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        transaction = Transaction()
+        # The lock does not wait so it is retried like the requests
+        for count in range(config.getint('database', 'retry'), -1, -1):
+            try:
+                transaction.database.lock(transaction.connection, cls._table)
+            except DatabaseOperationalError:
+                if not count:
+                    raise
+                transaction.rollback()
+                time.sleep(0.1)
+                continue
+            break
+        runs = cls.search([('end', '=', None)], limit=1)
+        if runs:
+            run, = runs
+        else:
+            run, = cls.create([{
+                        'cutoff': datetime.datetime.now(),
+                        }])
+        return run
+
+    @classmethod
+    def add_progress(cls, run_id, projects, duration):
+        'Add a chunk of projects recomputed in duration seconds to the run'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        # Incremented in SQL as several workers can share the run
+        cursor.execute(*table.update(
+                [table.chunks, table.projects, table.duration],
+                [table.chunks + 1, table.projects + projects,
+                    table.duration + duration],
+                where=table.id == run_id))
+
+    @classmethod
+    def finish(cls, run_id):
+        'Mark the run as finished'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.update([table.end], [datetime.datetime.now()],
+                where=(table.id == run_id) & (table.end == Null)))
+
+
+class ProjectPeriodSummary(ModelSQL, ModelView):
+    'Work Project Period Summary'
+    __name__ = 'work.project.period_summary'
+    project = fields.Many2One('work.project', 'Project')
+    company = fields.Many2One('company.company', 'Company')
+    year = fields.Integer('Year')
+    month = fields.Integer('Month')
+    category = fields.Selection([
+            ('labor', 'Labor'),
+            ('material', 'Material'),
+            ('other', 'Other'),
+            ], 'Category')
+    currency = fields.Many2One('currency.currency', 'Currency')
+    currency_digits = fields.Function(fields.Integer('Currency Digits'),
+        'on_change_with_currency_digits')
+    income = fields.Numeric('Income',
+        digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits'])
+    expense = fields.Numeric('Expense',
+        digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits'])
+    margin = fields.Numeric('Margin',
+        digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits'])
+
+    @classmethod
+    def __setup__(cls):
+        super(ProjectPeriodSummary, cls).__setup__()
+        cls._order = [
+            ('year', 'ASC'),
+            ('month', 'ASC'),
+            ('project', 'ASC'),
+            ('category', 'ASC'),
+            ]
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+    @classmethod
+    def _get_date_where(cls, column):
+        'Returns the condition on the date column from the context'
+        context = Transaction().context
+        where = column != Null
+        if context.get('from_date'):
+            where &= column >= context['from_date']
+        if context.get('to_date'):
+            where &= column <= context['to_date']
+        return where
+
+    @classmethod
+    def _get_period_columns(cls, table, source, date, category, income,
+            expense):
+        '''
+        Returns the columns shared by the queries of the records to bucket.
+        The ids of the records are spread by source so they do not collide.
+        '''
+        return [
+            (table.id * _PERIOD_SOURCES + source).as_('id'),
+            table.create_uid, table.create_date, table.write_uid,
+            table.write_date,
+            Extract('YEAR', date).cast('INTEGER').as_('year'),
+            Extract('MONTH', date).cast('INTEGER').as_('month'),
+            category.as_('category'),
+            income.as_('income'),
+            expense.as_('expense'),
+            ]
+
+    @classmethod
+    def _get_sale_lines_query(cls):
+        'Returns the query of the income and expense of the sale lines'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Currency = pool.get('currency.currency')
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        currency = Currency.__table__()
+        type_name = cls.income.sql_type().base
+        context = Transaction().context
+
+        join = line.join(sale, condition=sale.id == line.sale
+            ).join(currency, condition=currency.id == sale.currency
+            ).join(product, 'LEFT', condition=product.id == line.product
+            ).join(template, 'LEFT', condition=template.id == product.template)
+        join, cost_price = Project._join_sale_line_cost_price(
+            join, line, sale)
+        quantity = Coalesce(line.quantity, 0)
+        # The table query can not call the Python hooks
+        if Project._sale_line_hooks_overridden():
+            logger.warning('is_labour_line or is_other_line is overridden '
+                'but the period summary classifies the sale lines with '
+                '_sale_line_category_column')
+        category = Project._sale_line_category_column(line, template)
+        where = (Project._get_sale_lines_where(line, sale)
+            & (sale.project != Null)
+            & cls._get_date_where(sale.sale_date))
+        if context.get('company'):
+            where &= sale.company == context['company']
+        return join.select(
+            *(cls._get_period_columns(line, 0, sale.sale_date, category,
+                    _round_currency((quantity * Coalesce(line.unit_price, 0)
+                            ).cast(type_name), currency.rounding),
+                    Case((category == 'material',
+                            _round_currency((quantity * Coalesce(cost_price, 0)
+                                    ).cast(type_name), currency.rounding)),
+                        else_=0))
+                + [sale.project, sale.company, sale.currency]),
+            where=where)
+
+    @classmethod
+    def _get_supplier_invoice_lines_query(cls):
+        'Returns the query of the expense of the supplier invoice lines'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Currency = pool.get('currency.currency')
+        line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        currency = Currency.__table__()
+        type_name = cls.expense.sql_type().base
+        context = Transaction().context
+
+        where = ((line.type == 'line')
+            & (line.work_project != Null)
+            & (invoice.type == 'in')
+            & (invoice.state != 'cancel')
+            & cls._get_date_where(invoice.invoice_date))
+        if context.get('company'):
+            where &= invoice.company == context['company']
+        return line.join(invoice, condition=invoice.id == line.invoice
+            ).join(currency, condition=currency.id == invoice.currency
+            ).select(
+            *(cls._get_period_columns(line, 1, invoice.invoice_date,
+                    Literal('other'), Literal(0),
+                    _round_currency((line.quantity * line.unit_price).cast(
+                            type_name), currency.rounding))
+                + [line.work_project.as_('project'), invoice.company,
+                    invoice.currency]),
+            where=where)
+
+    @classmethod
+    def _get_timesheet_lines_query(cls):
+        'Returns the query of the cost of the timesheet lines'
+        pool = Pool()
+        Project = pool.get('work.project')
+        TimesheetLine = pool.get('timesheet.line')
+        Company = pool.get('company.company')
+        line = TimesheetLine.__table__()
+        company = Company.__table__()
+        type_name = cls.expense.sql_type().base
+        context = Transaction().context
+
+        works = Project._get_timesheet_works_query()
+        # Durations are stored as seconds on SQLite
+        if backend.name() == 'sqlite':
+            seconds = line.duration
+        else:
+            seconds = Extract('EPOCH', line.duration)
+        where = cls._get_date_where(line.date)
+        if context.get('company'):
+            where &= line.company == context['company']
+        # The cost is rounded once summed per period
+        return line.join(works, condition=works.work == line.work
+            ).join(company, condition=company.id == line.company
+            ).select(
+            *(cls._get_period_columns(line, 2, line.date, Literal('labor'),
+                    Literal(0),
+                    (Coalesce(seconds, 0) * line.cost_price / 3600).cast(
+                        type_name))
+                + [works.project, line.company, company.currency]),
+            where=where)
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        currency = Currency.__table__()
+
+        lines = Union(cls._get_sale_lines_query(),
+            cls._get_supplier_invoice_lines_query(),
+            cls._get_timesheet_lines_query(), all_=True)
+        income = _round_currency(Sum(lines.income), currency.rounding)
+        expense = _round_currency(Sum(lines.expense), currency.rounding)
+        return lines.join(currency, condition=currency.id == lines.currency
+            ).select(
+            Min(lines.id).as_('id'),
+            Max(lines.create_uid).as_('create_uid'),
+            Max(lines.create_date).as_('create_date'),
+            Max(lines.write_uid).as_('write_uid'),
+            Max(lines.write_date).as_('write_date'),
+            lines.project, lines.company, lines.currency, lines.year,
+            lines.month, lines.category,
+            income.as_('income'),
+            expense.as_('expense'),
+            (income - expense).as_('margin'),
+            group_by=[lines.project, lines.company, lines.currency,
+                currency.rounding, lines.year, lines.month, lines.category])
+
+
+class ProjectPeriodSummaryContext(ModelView):
+    'Work Project Period Summary Context'
+    __name__ = 'work.project.period_summary.context'
+    from_date = fields.Date('From Date',
+        help="Do not take into account records before the date.")
+    to_date = fields.Date('To Date',
+        help="Do not take into account records after the date.")
@@ -0,0 +1,403 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark the work_project function fields, searches and reports.
+
+Run it against the test database of trytond::
+
+    DB_NAME=benchmark python -m \\
+        trytond.modules.work_project.tests.benchmark_work_project \\
+        suite --projects 10000 --sales 50 --baseline baseline.json
+
+The suite generates synthetic companies, parties, projects, sales, lines,
+invoices and shipments then times each operation and reports its query
+count and wall time against the baseline, which --record writes.
+The sale-lines command times the read of the sale lines of one project
+while the sale_line table grows.
+'''
+import argparse
+import datetime
+import json
+import os
+import time
+from decimal import Decimal
+from sql import Column, Literal
+from sql.aggregate import Count
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER
+from trytond.model import fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart
+
+from .test_work_project import QueryCounter
+
+
+def create_products(company):
+    'Create a goods and a service product with accounts'
+    pool = Pool()
+    Account = pool.get('account.account')
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+
+    revenue, = Account.search([
+            ('kind', '=', 'revenue'),
+            ('company', '=', company.id),
+            ])
+    expense, = Account.search([
+            ('kind', '=', 'expense'),
+            ('company', '=', company.id),
+            ])
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = Template.create([{
+                'name': name,
+                'type': type_,
+                'default_uom': unit.id,
+                'list_price': Decimal(10),
+                'salable': True,
+                'sale_uom': unit.id,
+                'accounts_category': False,
+                'account_revenue': revenue.id,
+                'account_expense': expense.id,
+                } for name, type_ in [
+                ('Goods', 'goods'), ('Service', 'service')]])
+    return Product.create([{
+                'template': t.id,
+                'cost_price': Decimal(8),
+                } for t in templates])
+
+
+def create_sales(company, projects, sales_count, lines_count, products):
+    '''
+    Create for each project sales_count processing sales of lines_count
+    lines alternating the products and a line without product
+    '''
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+
+    products = list(products) + [None]
+    lines = []
+    for i in range(lines_count):
+        product = products[i % len(products)]
+        lines.append({
+                'product': product.id if product else None,
+                'unit': product.default_uom.id if product else None,
+                'description': 'Line %s' % i,
+                'quantity': i + 1,
+                'unit_price': Decimal('10'),
+                })
+    sales = Sale.create([{
+                'company': company.id,
+                'currency': company.currency.id,
+                'party': project.party.id,
+                'invoice_address': project.party.addresses[0].id,
+                'shipment_address': project.party.addresses[0].id,
+                'project': project.id,
+                'lines': [('create', lines)],
+                } for project in projects for _ in range(sales_count)])
+    Sale.write(sales, {
+            'state': 'processing',
+            'sale_date': datetime.date.today(),
+            })
+    return sales
+
+
+def create_invoices(company, sales):
+    'Create a customer invoice of the lines of each sale'
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Invoice = pool.get('account.invoice')
+
+    receivable, = Account.search([
+            ('kind', '=', 'receivable'),
+            ('company', '=', company.id),
+            ])
+    revenue, = Account.search([
+            ('kind', '=', 'revenue'),
+            ('company', '=', company.id),
+            ])
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    Invoice.create([{
+                'type': 'out',
+                'company': company.id,
+                'currency': company.currency.id,
+                'party': sale.party.id,
+                'invoice_address': sale.invoice_address.id,
+                'journal': journal.id,
+                'account': receivable.id,
+                'lines': [('create', [{
+                                'type': 'line',
+                                'quantity': line.quantity,
+                                'unit_price': line.unit_price,
+                                'account': revenue.id,
+                                'description': line.description,
+                                'origin': str(line),
+                                } for line in sale.lines])],
+                } for sale in sales])
+
+
+def create_shipments(company, sales):
+    'Create a customer shipment with the goods lines of each sale'
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Shipment = pool.get('stock.shipment.out')
+    Move = pool.get('stock.move')
+
+    warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+    customer, = Location.search([('type', '=', 'customer')], limit=1)
+    shipments = Shipment.create([{
+                'company': company.id,
+                'customer': sale.party.id,
+                'delivery_address': sale.shipment_address.id,
+                'warehouse': warehouse.id,
+                } for sale in sales])
+    Move.create([{
+                'company': company.id,
+                'shipment': str(shipment),
+                'origin': str(line),
+                'product': line.product.id,
+                'uom': line.unit.id,
+                'quantity': line.quantity,
+                'from_location': warehouse.output_location.id,
+                'to_location': customer.id,
+                'unit_price': line.unit_price,
+                'currency': company.currency.id,
+                } for sale, shipment in zip(sales, shipments)
+            for line in sale.lines
+            if line.product and line.product.type == 'goods'])
+
+
+def generate(companies_count, parties_count, projects_count, sales_count,
+        lines_count):
+    'Generate the data of the suite and return the projects'
+    pool = Pool()
+    Party = pool.get('party.party')
+    Project = pool.get('work.project')
+    Summary = pool.get('work.project.summary')
+
+    currency = None
+    projects = []
+    for company_index in range(companies_count):
+        company = create_company(name='Company %s' % company_index,
+            currency=currency)
+        currency = company.currency
+        with set_company(company):
+            create_chart(company)
+            products = create_products(company)
+            parties = Party.create([{
+                        'name': 'Customer %s' % i,
+                        'addresses': [('create', [{}])],
+                        } for i in range(parties_count)])
+            company_projects = Project.create([{
+                        'code': 'B%s-%s' % (company_index, i),
+                        'company': company.id,
+                        'party': parties[i % len(parties)].id,
+                        } for i in range(projects_count)])
+            for sub_projects in grouped_slice(company_projects, 100):
+                sales = create_sales(company, list(sub_projects),
+                    sales_count, lines_count, products)
+                create_invoices(company, sales)
+                create_shipments(company, sales)
+            projects.extend(company_projects)
+    Summary.rebuild()
+    cursor = Transaction().connection.cursor()
+    # Refresh the planner statistics as a production database would have
+    cursor.execute('ANALYZE')
+    return projects
+
+
+def clear_cache():
+    'Clear the transaction cache so each run starts cold'
+    for cache in Transaction().cache.itervalues():
+        cache.clear()
+
+
+def measure(func, repeat=3):
+    'Return the query count and the best wall time of func in seconds'
+    clear_cache()
+    with QueryCounter() as counter:
+        func()
+    timings = []
+    for _ in range(repeat):
+        clear_cache()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return counter.count, min(timings)
+
+
+def benchmark_suite(projects, page_size, repeat):
+    'Return the name, query count and wall time of each operation'
+    pool = Pool()
+    Project = pool.get('work.project')
+    ProjectSaleLine = pool.get('work.project.sale.line')
+
+    ids = [p.id for p in projects[:page_size]]
+    operations = []
+    for name, field in sorted(Project._fields.iteritems()):
+        if not isinstance(field, fields.Function):
+            continue
+        operations.append(('read %s' % name,
+                lambda name=name: Project.read(ids, [name])))
+    operations.append(('search pending shipment',
+            lambda: Project.search([('shipment_state', '!=', 'sent')])))
+    operations.append(('read sale lines', lambda: ProjectSaleLine.search_read(
+                [('project', '=', ids[0])],
+                fields_names=['product', 'quantity', 'amount'])))
+    for name, func in operations:
+        queries, duration = measure(func, repeat=repeat)
+        yield name, queries, duration
+
+
+def report(results, baseline):
+    'Print the results compared to the baseline'
+    for name, queries, duration in results:
+        line = '%-40s %6d queries %10.2f ms' % (name, queries,
+            duration * 1000)
+        if name in baseline:
+            reference = baseline[name]
+            line += '  baseline %6d queries %10.2f ms (%+.0f%%)' % (
+                reference['queries'], reference['ms'],
+                (duration * 1000 / reference['ms'] - 1) * 100
+                if reference['ms'] else 0)
+        print(line)
+
+
+def create_sale_lines(company, projects):
+    'Create one confirmed sale with one line for each project'
+    create_sales(company, projects, 1, 1, [])
+
+
+def double_sale_lines(exclude_sale):
+    '''
+    Duplicate the rows of sale_line except those of exclude_sale and return
+    the new row count
+    '''
+    pool = Pool()
+    SaleLine = pool.get('sale.line')
+    cursor = Transaction().connection.cursor()
+    table = SaleLine.__table__()
+
+    columns = [Column(table, name)
+        for name, field in SaleLine._fields.iteritems()
+        if name != 'id' and not hasattr(field, 'get')]
+    cursor.execute(*table.insert(columns, table.select(*columns,
+                where=table.sale != exclude_sale.id)))
+    # Refresh the planner statistics as a production database would have
+    cursor.execute('ANALYZE')
+    cursor.execute(*table.select(Count(Literal('*'))))
+    return cursor.fetchone()[0]
+
+
+def timeit(func, repeat=5):
+    'Return the best wall time of func in seconds'
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def benchmark_sale_lines(max_lines, projects_count):
+    pool = Pool()
+    Party = pool.get('party.party')
+    Project = pool.get('work.project')
+    ProjectSaleLine = pool.get('work.project.sale.line')
+
+    company = create_company()
+    with set_company(company):
+        party, = Party.create([{
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        projects = Project.create([{
+                    'code': 'B%s' % i,
+                    'company': company.id,
+                    'party': party.id,
+                    } for i in range(projects_count)])
+        create_sale_lines(company, projects)
+        project = projects[0]
+        sale, = project.sales
+
+        count = projects_count
+        while count <= max_lines:
+            duration = timeit(lambda: ProjectSaleLine.search_read(
+                    [('project', '=', project.id)],
+                    fields_names=['product', 'quantity', 'amount']))
+            print('%10d sale lines: %8.2f ms' % (count, duration * 1000))
+            count = double_sale_lines(sale)
+
+
+def run_suite(args):
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file_:
+            baseline = json.load(file_)
+
+    projects = generate(args.companies, args.parties, args.projects,
+        args.sales, args.lines)
+    with set_company(projects[0].company):
+        results = list(benchmark_suite(projects, args.page_size,
+                args.repeat))
+    report(results, baseline)
+
+    if args.record:
+        with open(args.baseline, 'w') as file_:
+            json.dump(dict((name, {
+                            'queries': queries,
+                            'ms': round(duration * 1000, 2),
+                            }) for name, queries, duration in results),
+                file_, indent=4, sort_keys=True)
+
+
+def run_sale_lines(args):
+    benchmark_sale_lines(args.max_lines, args.projects)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers()
+
+    suite = subparsers.add_parser('suite',
+        help='time the function fields, searches and reports')
+    suite.add_argument('--companies', type=int, default=1)
+    suite.add_argument('--parties', type=int, default=10)
+    suite.add_argument('--projects', type=int, default=100,
+        help='number of projects per company')
+    suite.add_argument('--sales', type=int, default=5,
+        help='number of sales per project')
+    suite.add_argument('--lines', type=int, default=5,
+        help='number of lines per sale')
+    suite.add_argument('--page-size', type=int, default=1000,
+        help='number of projects read at once')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--baseline', help='JSON file of the baseline')
+    suite.add_argument('--record', action='store_true',
+        help='write the results as baseline')
+    suite.set_defaults(func=run_suite)
+
+    sale_lines = subparsers.add_parser('sale-lines',
+        help='time the sale lines read as the sale_line table grows')
+    sale_lines.add_argument('--max-lines', type=int, default=2 ** 20,
+        help='stop when sale_line has more rows')
+    sale_lines.add_argument('--projects', type=int, default=100,
+        help='number of projects sharing the sale lines')
+    sale_lines.set_defaults(func=run_sale_lines)
+
+    args = parser.parse_args()
+    if getattr(args, 'record', False) and not args.baseline:
+        parser.error('--record requires --baseline')
+
+    activate_module('work_project')
+    with Transaction().start(DB_NAME, USER, context={}):
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,963 @@
 # copyright notices and license terms.
 import unittest
 import doctest
+import csv
+import logging
+import datetime
+from io import BytesIO
+from decimal import Decimal
+
+from trytond import backend
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import test_view, test_depends
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
+from trytond.tests.test_tryton import activate_module, drop_db
+from trytond.modules import get_module_list
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency, add_currency_rate
+from trytond.modules.account.tests import create_chart
+from trytond.modules.work_project import instrumentation
+from trytond.modules.work_project.instrumentation import QueryCounter
+
+
+def create_projects(company, count):
+    'Create count projects with one sale each'
+    pool = Pool()
+    Party = pool.get('party.party')
+    Sale = pool.get('sale.sale')
+    Project = pool.get('work.project')
+
+    party, = Party.create([{
+                'name': 'Customer',
+                'addresses': [('create', [{}])],
+                }])
+    address, = party.addresses
+    projects = Project.create([{
+                'code': 'P%s' % i,
+                'company': company.id,
+                'party': party.id,
+                } for i in range(count)])
+    Sale.create([{
+                'company': company.id,
+                'currency': company.currency.id,
+                'party': party.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+                'project': project.id,
+                'lines': [('create', [{
+                                'description': 'Other',
+                                'quantity': 2,
+                                'unit_price': Decimal('10'),
+                                }])],
+                } for project in projects])
+    return projects
+
+
+class WorkProjectTestCase(ModuleTestCase):
+    'Test Work Project module'
+    module = 'work_project'
+
+    @with_transaction()
+    def test_margins_query_count(self):
+        'Test margins are computed with a constant number of queries'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Summary = pool.get('work.project.summary')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 5)
+            # Compute live instead of reading the stored summary
+            Summary.delete(Summary.search([]))
+            names = ['margin_labor', 'margin_material', 'margin_other',
+                'margin_percent_labor', 'margin_percent_material',
+                'margin_percent_other']
+            Project.get_amounts(Project.browse(projects), names[:1])
+            counts = []
+            for i in range(1, len(names) + 1):
+                with QueryCounter() as counter:
+                    result = Project.get_amounts(
+                        Project.browse(projects), names[:i])
+                counts.append(counter.queries)
+            self.assertEqual(len(set(counts)), 1)
+            self.assertGreater(counts[0], 1)
+            self.assertEqual(result['margin_other'],
+                dict((p.id, Decimal('20.00')) for p in projects))
+            self.assertEqual(result['margin_percent_other'],
+                dict((p.id, Decimal('1.0000')) for p in projects))
+
+    @with_transaction()
+    def test_sale_line_hooks(self):
+        'Test overridden classification hooks are used for the sale lines'
+        pool = Pool()
+        Project = pool.get('work.project')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            amounts = Project._compute_amounts([project])[project.id]
+            self.assertEqual(amounts['income_other'], Decimal('20.00'))
+
+            hooks = dict((n, getattr(Project, n).im_func)
+                for n in ['is_labour_line', 'is_other_line'])
+            Project.is_other_line = lambda self, line: False
+            Project.is_labour_line = lambda self, line: True
+            try:
+                self.assertTrue(Project._sale_line_hooks_overridden())
+                amounts = Project._compute_amounts([project])[project.id]
+            finally:
+                for name, func in hooks.iteritems():
+                    setattr(Project, name, func)
+            self.assertEqual(amounts['income_other'], Decimal('0.00'))
+            self.assertEqual(amounts['income_labor'], Decimal('20.00'))
+            self.assertFalse(Project._sale_line_hooks_overridden())
+
+    @with_transaction()
+    def test_summary_refresh(self):
+        'Test project summary is refreshed when sales change'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Summary = pool.get('work.project.summary')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            summary, = Summary.search([('project', '=', project.id)])
+            self.assertEqual(summary.income_other, Decimal('20.00'))
+            compute_date = summary.compute_date
+
+            sale, = project.sales
+            SaleLine.create([{
+                        'sale': sale.id,
+                        'description': 'Other',
+                        'quantity': 1,
+                        'unit_price': Decimal('5'),
+                        }])
+            summary, = Summary.search([('project', '=', project.id)])
+            self.assertEqual(summary.income_other, Decimal('25.00'))
+            self.assertGreaterEqual(summary.compute_date, compute_date)
+            self.assertEqual(Project(project.id).income_other,
+                Decimal('25.00'))
+
+            Summary.delete([summary])
+            self.assertEqual(Project(project.id).income_other,
+                Decimal('25.00'))
+            Summary.fill()
+            self.assertEqual(
+                Project.search([('income_other', '=', Decimal('25.00'))]),
+                [project])
+            Summary.rebuild()
+            summary, = Summary.search([('project', '=', project.id)])
+            self.assertEqual(summary.margin_other, Decimal('25.00'))
+
+    @with_transaction()
+    def test_summary_refresh_dependencies(self):
+        'Test summary is refreshed when the products of the lines change'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        Account = pool.get('account.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('kind', '=', 'revenue')])
+            project, = create_projects(company, 1)
+            sale, = project.sales
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'salable': True,
+                        'sale_uom': unit.id,
+                        'accounts_category': False,
+                        'account_revenue': revenue.id,
+                        'list_price': Decimal('10'),
+                        'products': [('create', [{
+                                        'cost_price': Decimal('4'),
+                                        }])],
+                        }])
+            product, = template.products
+            Sale.write([sale], {
+                    'lines': [('create', [{
+                                    'product': product.id,
+                                    'description': 'Product',
+                                    'unit': unit.id,
+                                    'quantity': 1,
+                                    'unit_price': Decimal('10'),
+                                    }])],
+                    })
+            project = Project(project.id)
+            self.assertEqual(project.expense_material, Decimal('4.00'))
+
+            product.cost_price = Decimal('6')
+            product.save()
+            self.assertEqual(Project(project.id).expense_material,
+                Decimal('6.00'))
+
+            Template.write([template], {'type': 'service'})
+            project = Project(project.id)
+            self.assertEqual(project.income_labor, Decimal('10.00'))
+            self.assertEqual(project.income_material, Decimal('0.00'))
+
+    @with_transaction()
+    def test_shipment_state(self):
+        'Test stored shipment state, search and order'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            sent, partially, waiting = create_projects(company, 3)
+            sale, = Sale.copy(sent.sales, {'project': partially.id})
+            Sale.write(list(sent.sales) + [sale], {'shipment_state': 'sent'})
+            empty, = Project.create([{
+                        'code': 'EMPTY',
+                        'company': company.id,
+                        'party': sent.party.id,
+                        }])
+
+            self.assertEqual(
+                [p.shipment_state for p in Project.browse(
+                        [sent, partially, waiting, empty])],
+                ['sent', 'partially sent', 'waiting', 'none'])
+            self.assertEqual(
+                Project.search([('shipment_state', '!=', 'sent')],
+                    order=[('id', 'ASC')]),
+                [partially, waiting, empty])
+            self.assertEqual(
+                Project.search([('shipment_state', 'in', ['sent', 'none'])],
+                    order=[('id', 'ASC')]),
+                [sent, empty])
+            self.assertEqual(
+                Project.search([
+                        ('shipment_state', 'not in', ['sent', 'none']),
+                        ], order=[('id', 'ASC')]),
+                [partially, waiting])
+            self.assertEqual(
+                Project.search([], order=[('shipment_state', 'ASC')]),
+                [empty, partially, sent, waiting])
+
+            Sale.write([sale], {'project': empty.id})
+            self.assertEqual(
+                [p.shipment_state for p in Project.browse([partially, empty])],
+                ['waiting', 'sent'])
+            Sale.delete([sale])
+            self.assertEqual(Project(empty.id).shipment_state, 'none')
+
+    @with_transaction()
+    def test_shipment_state_access(self):
+        'Test the shipment state is stored for the sale users'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+        ModelData = pool.get('ir.model.data')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            user, = User.create([{
+                        'name': 'Salesman',
+                        'login': 'salesman',
+                        'main_company': company.id,
+                        'company': company.id,
+                        'groups': [('add', [
+                                        ModelData.get_id('sale',
+                                            'group_sale')])],
+                        }])
+
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(_check_access=True):
+                Sale.write(list(project.sales), {'shipment_state': 'sent'})
+            self.assertEqual(Project(project.id).shipment_state, 'sent')
+
+    @with_transaction()
+    def test_sale_graph_cache(self):
+        'Test sale relations are walked once until a record is written'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 3)
+            names = ['moves', 'shipments', 'shipment_returns', 'invoices']
+            Project.get_sale_relations(projects, names)
+            with QueryCounter() as counter:
+                Project.get_sale_relations(projects, names)
+            self.assertEqual(counter.queries, 0)
+            with QueryCounter() as counter:
+                Project.get_sale_relations(projects, ['sales'] + names)
+            self.assertEqual(counter.queries, 1)
+
+            project = projects[0]
+            sale, = Sale.copy(project.sales)
+            self.assertEqual(len(Project._get_sale_graph(
+                        [project])[project.id]['sales']), 2)
+
+    @with_transaction()
+    def test_sale_line_work_project(self):
+        'Test the project of the sale is stored on its lines'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            first, second = create_projects(company, 2)
+            sale, = first.sales
+            line, = sale.lines
+            self.assertEqual(line.work_project, first)
+
+            new_line, = SaleLine.copy([line])
+            self.assertEqual(new_line.work_project, first)
+
+            Sale.write([sale], {'project': second.id})
+            self.assertEqual(
+                SaleLine.search([('work_project', '=', second.id)],
+                    order=[('id', 'ASC')]),
+                [line] + list(second.sales[0].lines) + [new_line])
+
+    @with_transaction()
+    def test_expense_labor(self):
+        'Test labour expense from the timesheet of the sale works'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Party = pool.get('party.party')
+        Employee = pool.get('company.employee')
+        EmployeeCostPrice = pool.get('company.employee_cost_price')
+        Work = pool.get('timesheet.work')
+        TimesheetLine = pool.get('timesheet.line')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            sale, = project.sales
+            sale_line, = sale.lines
+            party, = Party.create([{'name': 'Employee'}])
+            employee, = Employee.create([{
+                        'party': party.id,
+                        'company': company.id,
+                        }])
+            EmployeeCostPrice.create([{
+                        'employee': employee.id,
+                        'date': datetime.date(2000, 1, 1),
+                        'cost_price': Decimal('20'),
+                        }])
+            works = Work.create([{
+                        'name': 'Sale',
+                        'company': company.id,
+                        'origin': str(sale),
+                        }, {
+                        'name': 'Sale Line',
+                        'company': company.id,
+                        'origin': str(sale_line),
+                        }])
+            TimesheetLine.create([{
+                        'company': company.id,
+                        'employee': employee.id,
+                        'work': work.id,
+                        'date': date,
+                        'duration': datetime.timedelta(hours=hours),
+                        } for work, hours, date in zip(works, [3, 1.5],
+                        [datetime.date(2020, 1, 1), datetime.date(2020, 2, 1)])
+                    ])
+
+            project = Project(project.id)
+            self.assertEqual(project.expense_labor, Decimal('90.00'))
+            self.assertEqual(project.margin_labor, Decimal('-90.00'))
+
+            with Transaction().set_context(
+                    from_date=datetime.date(2020, 2, 1)):
+                project = Project(project.id)
+                self.assertEqual(project.expense_labor, Decimal('30.00'))
+
+    @with_transaction()
+    def test_currency_conversion(self):
+        'Test amounts in other currencies are converted at their date rate'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        Summary = pool.get('work.project.summary')
+
+        company = create_company()
+        euro = create_currency('eur')
+        add_currency_rate(euro, 2, datetime.date(2000, 1, 1))
+        add_currency_rate(euro, 4, datetime.date(2010, 1, 1))
+        add_currency_rate(company.currency, 1, datetime.date(2000, 1, 1))
+        with set_company(company):
+            project, = create_projects(company, 1)
+            sale, = project.sales
+            Sale.copy([sale], {
+                    'currency': euro.id,
+                    'sale_date': datetime.date(2005, 1, 1),
+                    })
+            Sale.copy([sale], {'currency': euro.id})
+
+            project = Project(project.id)
+            self.assertEqual(project.income_other, Decimal('35.00'))
+            keys = [
+                (euro.id, datetime.date(2005, 1, 1)),
+                (euro.id, datetime.date.today()),
+                ]
+            Project._get_currency_rates(keys)
+            with QueryCounter() as counter:
+                rates = Project._get_currency_rates(keys)
+            self.assertEqual(counter.queries, 0)
+            self.assertEqual(sorted(rates.values()),
+                [Decimal(2), Decimal(4)])
+
+            # A sale before the first rate can not be converted
+            other, = create_projects(company, 1)
+            sale, = Sale.copy([sale])
+            table = Sale.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update(
+                    [table.project, table.currency, table.sale_date],
+                    [other.id, euro.id, datetime.date(1990, 1, 1)],
+                    where=table.id == sale.id))
+            Summary.delete(Summary.search([]))
+            Summary.fill(skip_errors=True)
+            self.assertEqual([s.project for s in Summary.search([])],
+                [project])
+            self.assertRaises(UserError, Summary.fill)
+
+    @with_transaction()
+    def test_close_project(self):
+        'Test closed projects keep their figures until reopened'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        Summary = pool.get('work.project.summary')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            Project.close([project])
+            self.assertEqual(project.state, 'closed')
+
+            sale, = project.sales
+            Sale.copy([sale])
+            Sale.write([sale], {'shipment_state': 'sent'})
+            project = Project(project.id)
+            self.assertEqual(project.income_other, Decimal('20.00'))
+            self.assertEqual(project.shipment_state, 'waiting')
+            self.assertEqual(
+                Project.search([('income_other', '=', Decimal('20.00'))]),
+                [project])
+
+            Summary.rebuild()
+            self.assertEqual(Project(project.id).income_other,
+                Decimal('20.00'))
+            Summary.delete(Summary.search([('project', '=', project.id)]))
+            Summary.rebuild()
+            self.assertEqual(
+                Summary.search([('project', '=', project.id)])[0].income_other,
+                Decimal('40.00'))
+
+            Project.reopen([project])
+            project = Project(project.id)
+            self.assertEqual(project.state, 'open')
+            self.assertEqual(project.income_other, Decimal('40.00'))
+            self.assertEqual(project.shipment_state, 'partially sent')
+
+    @with_transaction()
+    def test_get_kpis(self):
+        'Test KPIs are returned by column with the totals of the domain'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 3)
+            kpis = Project.get_kpis([], ['income_other', 'shipment_state',
+                    'margin_percent_other'], limit=2, totals=True)
+            self.assertEqual(kpis['ids'], [p.id for p in projects[:2]])
+            self.assertEqual(kpis['income_other'],
+                [Decimal('20.00'), Decimal('20.00')])
+            self.assertEqual(kpis['shipment_state'], ['waiting', 'waiting'])
+            self.assertEqual(kpis['totals'], {
+                    'income_other': Decimal('60.00'),
+                    'margin_percent_other': Decimal('1.0000'),
+                    })
+
+            # The totals follow the dates of the context like the amounts
+            Sale.write(list(projects[2].sales), {
+                    'sale_date': datetime.date(2021, 6, 1),
+                    })
+            with Transaction().set_context(
+                    from_date=datetime.date(2021, 1, 1)):
+                kpis = Project.get_kpis([], ['income_other'], limit=2,
+                    totals=True)
+            self.assertEqual(kpis['income_other'],
+                [Decimal('0.00'), Decimal('0.00')])
+            self.assertEqual(kpis['totals'], {
+                    'income_other': Decimal('20.00'),
+                    })
+
+    @with_transaction()
+    def test_recompute_chunk(self):
+        'Test metrics are recomputed by chunks of stale projects'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Run = pool.get('work.project.summary.run')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 3)
+            run = Run.get_current()
+            self.assertEqual(Run.get_current(), run)
+
+            results = []
+            last_id = 0
+            while last_id is not None:
+                last_id, count = Project._recompute_chunk(
+                    run.cutoff, last_id, 2)
+                results.append((last_id, count))
+            self.assertEqual(results,
+                [(projects[1].id, 2), (projects[2].id, 1), (None, 0)])
+            self.assertEqual(
+                Project._recompute_chunk(run.cutoff, 0, 2), (None, 0))
+
+            Run.add_progress(run.id, 2, 0.5)
+            Run.finish(run.id)
+            values, = Run.read([run.id],
+                ['chunks', 'projects', 'duration', 'end'])
+            self.assertEqual(
+                (values['chunks'], values['projects'], values['duration']),
+                (1, 2, 0.5))
+            self.assertTrue(values['end'])
+
+    @with_transaction()
+    def test_summary_run_lock(self):
+        'Test the current run is retried while another worker locks it'
+        pool = Pool()
+        Run = pool.get('work.project.summary.run')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        database = Transaction().database
+        calls = []
+
+        def lock(connection, table):
+            calls.append(table)
+            if len(calls) == 1:
+                raise DatabaseOperationalError
+        database.lock = lock
+        try:
+            run = Run.get_current()
+        finally:
+            del database.lock
+        self.assertEqual(calls, [Run._table, Run._table])
+        self.assertEqual(Run.search([]), [run])
+
+    @with_transaction()
+    def test_period_summary(self):
+        'Test project figures bucketed by month'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        Employee = pool.get('company.employee')
+        EmployeeCostPrice = pool.get('company.employee_cost_price')
+        Work = pool.get('timesheet.work')
+        TimesheetLine = pool.get('timesheet.line')
+        PeriodSummary = pool.get('work.project.period_summary')
+
+        company = create_company()
+        with set_company(company):
+            project, other = create_projects(company, 2)
+            Sale.write(list(project.sales + other.sales), {
+                    'state': 'processing',
+                    'sale_date': datetime.date(2020, 1, 15),
+                    })
+            party, = Party.create([{'name': 'Employee'}])
+            employee, = Employee.create([{
+                        'party': party.id,
+                        'company': company.id,
+                        }])
+            EmployeeCostPrice.create([{
+                        'employee': employee.id,
+                        'date': datetime.date(2000, 1, 1),
+                        'cost_price': Decimal('20'),
+                        }])
+            work, = Work.create([{
+                        'name': 'Sale',
+                        'company': company.id,
+                        'origin': str(project.sales[0]),
+                        }])
+            TimesheetLine.create([{
+                        'company': company.id,
+                        'employee': employee.id,
+                        'work': work.id,
+                        'date': date,
+                        'duration': datetime.timedelta(hours=1),
+                        } for date in [datetime.date(2020, 2, 1),
+                        datetime.date(2020, 2, 29),
+                        datetime.date(2020, 3, 1)]])
+
+            with Transaction().set_context(
+                    from_date=datetime.date(2020, 1, 1),
+                    to_date=datetime.date(2020, 2, 29)):
+                summaries = PeriodSummary.search([])
+                self.assertEqual(
+                    [(s.project, s.year, s.month, s.category, s.income,
+                            s.expense, s.margin) for s in summaries], [
+                        (project, 2020, 1, 'other', Decimal('20.00'),
+                            Decimal('0.00'), Decimal('20.00')),
+                        (other, 2020, 1, 'other', Decimal('20.00'),
+                            Decimal('0.00'), Decimal('20.00')),
+                        (project, 2020, 2, 'labor', Decimal('0.00'),
+                            Decimal('40.00'), Decimal('-40.00')),
+                        ])
+
+    @with_transaction()
+    def test_sale_state(self):
+        'Test the period summary counts the sales like the project figures'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        PeriodSummary = pool.get('work.project.period_summary')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            sale, = project.sales
+            Sale.write([sale], {
+                    'state': 'processing',
+                    'sale_date': datetime.date(2020, 1, 15),
+                    })
+            Sale.copy([sale], {'sale_date': sale.sale_date})
+
+            with Transaction().set_context(
+                    from_date=datetime.date(2020, 1, 1),
+                    to_date=datetime.date(2020, 1, 31)):
+                self.assertEqual(
+                    Project(project.id).income_other, Decimal('40.00'))
+                self.assertEqual(
+                    [s.income for s in PeriodSummary.search([])],
+                    [Decimal('40.00')])
+
+    @with_transaction()
+    def test_export_financials(self):
+        'Test export of project financials as CSV by chunks'
+        pool = Pool()
+        Project = pool.get('work.project')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 3)
+            file_ = BytesIO()
+            Project.write_financials_csv(projects, file_, chunk_size=2)
+            rows = list(csv.reader(BytesIO(file_.getvalue())))
+            self.assertEqual(len(rows), 4)
+            header = rows[0]
+            self.assertEqual(header[:2], ['Code', 'Party'])
+            for project, row in zip(projects, rows[1:]):
+                values = dict(zip(header, row))
+                self.assertEqual(values['Code'], project.code)
+                self.assertEqual(values['Party'], 'Customer')
+                self.assertEqual(values['Income Other'], '20.00')
+                self.assertEqual(values['Amount To Invoice'], '20.00')
+
+            Report = pool.get('work.project.financials', type='report')
+            oext, content, _, _ = Report.execute([projects[0].id], {})
+            self.assertEqual(oext, 'csv')
+            self.assertEqual(len(list(csv.reader(BytesIO(content)))), 2)
+            oext, content, _, _ = Report.execute([], {
+                    'domain': [('code', 'in', ['P1', 'P2'])],
+                    })
+            self.assertEqual([r[0] for r in csv.reader(BytesIO(content))][1:],
+                ['P1', 'P2'])
+
+    @with_transaction()
+    def test_profile(self):
+        'Test profiling logs the queries and cache hits of getters'
+        pool = Pool()
+        Project = pool.get('work.project')
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(instrumentation.__name__)
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        config.add_section('work_project')
+        config.set('work_project', 'profile', 'True')
+        try:
+            get_amounts = instrumentation.profile(
+                Project.get_amounts.__func__)
+        finally:
+            config.remove_section('work_project')
+
+        company = create_company()
+        with set_company(company):
+            projects = create_projects(company, 2)
+            try:
+                get_amounts(Project, projects, ['income_other'])
+            finally:
+                logger.removeHandler(handler)
+                logger.setLevel(level)
+        record, = records
+        self.assertEqual(record.getMessage().split(', ')[1:],
+            ['1 queries', '2 records', '2 cache hits'])
+
+    @with_transaction()
+    def test_configuration_cache(self):
+        'Test company configuration cache and project code allocation'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Configuration = pool.get('work.project.configuration')
+        Sequence = pool.get('ir.sequence')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            self.assertFalse(Project.default_code_readonly())
+            with QueryCounter() as counter:
+                self.assertFalse(Project.default_code_readonly())
+            self.assertEqual(counter.queries, 0)
+
+            sequence, = Sequence.create([{
+                        'name': 'Project',
+                        'code': 'work.project',
+                        'company': company.id,
+                        'prefix': 'PRJ',
+                        }])
+            Configuration.write([Configuration(1)], {
+                    'project_sequence': sequence.id,
+                    })
+            self.assertTrue(Project.default_code_readonly())
+            self.assertEqual(Configuration(1).project_sequence, sequence)
+
+            party, = Party.create([{'name': 'Customer'}])
+            projects = Project.create([{
+                        'company': company.id,
+                        'party': party.id,
+                        } for _ in range(3)])
+            self.assertEqual([p.code for p in projects],
+                ['PRJ1', 'PRJ2', 'PRJ3'])
+            copies = Project.copy(projects[:2])
+            self.assertEqual([p.code for p in copies], ['PRJ4', 'PRJ5'])
+
+    @with_transaction()
+    def test_sale_line_stable_id(self):
+        'Test project sale line id and amount when lines are added'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            Sale.write(list(project.sales), {
+                    'state': 'processing',
+                    'sale_date': datetime.date.today(),
+                    })
+            sale_line, = Project(project.id).sale_lines
+            self.assertEqual(sale_line.quantity, 2)
+
+            sale, = project.sales
+            SaleLine.create([{
+                        'sale': sale.id,
+                        'description': 'Other',
+                        'quantity': 1,
+                        'unit_price': Decimal('5'),
+                        }])
+            new_sale_line, = Project(project.id).sale_lines
+            self.assertEqual(new_sale_line.id, sale_line.id)
+            self.assertEqual(new_sale_line.quantity, 3)
+            self.assertEqual(new_sale_line.amount, Decimal('25.00'))
+
+            SaleLine.delete([sale.lines[0]])
+            new_sale_line, = Project(project.id).sale_lines
+            self.assertEqual(new_sale_line.id, sale_line.id)
+            self.assertEqual(new_sale_line.quantity, 1)
+            self.assertEqual(new_sale_line.amount, Decimal('5.00'))
+
+            SaleLine.delete(list(Sale(sale.id).lines))
+            self.assertEqual(Project(project.id).sale_lines, ())
+
+    @with_transaction()
+    def test_rounding(self):
+        'Test project amounts are rounded half to even as the sale lines'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        PeriodSummary = pool.get('work.project.period_summary')
+
+        company = create_company()
+        with set_company(company):
+            project, = create_projects(company, 1)
+            sale, = project.sales
+            SaleLine.create([{
+                        'sale': sale.id,
+                        'description': 'Other',
+                        'quantity': 1,
+                        'unit_price': unit_price,
+                        } for unit_price in [Decimal('0.125'),
+                        Decimal('0.125'), Decimal('0.135')]])
+            Sale.write([sale], {
+                    'state': 'processing',
+                    'sale_date': datetime.date.today(),
+                    })
+            sale = Sale(sale.id)
+            self.assertEqual(sale.untaxed_amount, Decimal('20.38'))
+
+            project = Project(project.id)
+            sale_line, = project.sale_lines
+            self.assertEqual(sale_line.amount, sale.untaxed_amount)
+            self.assertEqual(project.income_other, sale.untaxed_amount)
+            summary, = PeriodSummary.search([])
+            self.assertEqual(summary.income, sale.untaxed_amount)
+
+    @with_transaction()
+    def test_search_order_amounts(self):
+        'Test search and order on project amounts'
+        pool = Pool()
+        Project = pool.get('work.project')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            small, big = create_projects(company, 2)
+            sale, = big.sales
+            SaleLine.create([{
+                        'sale': sale.id,
+                        'description': 'Other',
+                        'quantity': 1,
+                        'unit_price': Decimal('30'),
+                        }])
+
+            self.assertEqual(
+                Project.search([('income_other', '>', Decimal('20'))]),
+                [big])
+            self.assertEqual(
+                Project.search([('amount_to_invoice', '=', Decimal('20'))]),
+                [small])
+            self.assertEqual(
+                Project.search([], order=[('margin_other', 'DESC')]),
+                [big, small])
+
+
+@unittest.skipIf(
+    'sale_opportunity_purchase_relation' not in get_module_list(),
+    'sale_opportunity_purchase_relation is not available')
+class WorkProjectPurchaseTestCase(unittest.TestCase):
+    'Test Work Project module with purchases'
+
+    @classmethod
+    def setUpClass(cls):
+        drop_db()
+        activate_module('work_project')
+        activate_module('sale_opportunity_purchase_relation')
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_db()
 
+    @with_transaction()
+    def test_purchase_relations(self):
+        'Test the purchases and supplier invoices of the projects'
+        pool = Pool()
+        Project = pool.get('work.project')
+        Purchase = pool.get('purchase.purchase')
+        Invoice = pool.get('account.invoice')
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        OpenPurchases = pool.get('work.project.open_purchases',
+            type='wizard')
+        OpenPurchaseInvoices = pool.get(
+            'work.project.open_purchase_invoices', type='wizard')
 
-class TestCase(unittest.TestCase):
-    'Test module'
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            payable, = Account.search([('kind', '=', 'payable')])
+            expense, = Account.search([('kind', '=', 'expense')])
+            journal, = Journal.search([('type', '=', 'expense')])
+            project, other = create_projects(company, 2)
+            sale_line, = project.sales[0].lines
+            party = project.party
+            address, = party.addresses
 
-    def setUp(self):
-        trytond.tests.test_tryton.install_module('work_project')
+            # The sale_lines field is a Many2Many or a One2Many depending on
+            # the version of sale_opportunity_purchase_relation
+            purchase, = Purchase.create([{
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'party': party.id,
+                        'invoice_address': address.id,
+                        'lines': [('create', [{
+                                        'description': 'Other',
+                                        'quantity': 2,
+                                        'unit_price': Decimal('5'),
+                                        'sale_lines': [
+                                            ('add', [sale_line.id])],
+                                        }])],
+                        }])
+            purchase_line, = purchase.lines
+            invoice, = Invoice.create([{
+                        'type': 'in',
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'party': party.id,
+                        'invoice_address': address.id,
+                        'account': payable.id,
+                        'journal': journal.id,
+                        'lines': [('create', [{
+                                        'company': company.id,
+                                        'account': expense.id,
+                                        'description': 'Other',
+                                        'quantity': 2,
+                                        'unit_price': Decimal('5'),
+                                        'origin': str(purchase_line),
+                                        }])],
+                        }])
 
-    def test0005views(self):
-        'Test views'
-        test_view('work_project')
+            project = Project(project.id)
+            self.assertEqual(project.purchases, (purchase,))
+            self.assertEqual(project.purchase_invoices, (invoice,))
+            self.assertEqual(Project(other.id).purchases, ())
+            self.assertEqual(
+                Project.search([('purchases', '=', purchase.id)]), [project])
+            self.assertEqual(
+                Project.search([('purchase_invoices', '!=', None)]),
+                [project])
 
-    def test0006depends(self):
-        'Test depends'
-        test_depends()
+            for Wizard, records, Model in [
+                    (OpenPurchases, [purchase], Purchase),
+                    (OpenPurchaseInvoices, [invoice], Invoice)]:
+                session_id, _, _ = Wizard.create()
+                with Transaction().set_context(
+                        active_model='work.project',
+                        active_ids=[project.id, other.id]):
+                    action, _ = Wizard(session_id).do_open_({})
+                Wizard.delete(session_id)
+                self.assertEqual(Model.search(
+                        PYSONDecoder().decode(action['pyson_domain'])),
+                    records)
 
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
-    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            WorkProjectTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            WorkProjectPurchaseTestCase))
     suite.addTests(doctest.DocFileSuite('scenario_work_project.rst',
             setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
@@ -0,0 +1,97 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond import backend
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Work', 'TimesheetLine']
+
+
+class Work:
+    __name__ = 'timesheet.work'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def _get_origin(cls):
+        return super(Work, cls)._get_origin() + ['sale.sale', 'sale.line']
+
+    @classmethod
+    def _get_work_projects(cls, works):
+        'Returns the ids of the projects related to the works'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        projects = set()
+        for work in cls.browse([w.id for w in works]):
+            sale = None
+            if isinstance(work.origin, Sale):
+                sale = work.origin
+            elif isinstance(work.origin, SaleLine):
+                sale = work.origin.sale
+            if sale and sale.project:
+                projects.add(sale.project.id)
+        return projects
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        all_works = []
+        for works, _ in zip(actions, actions):
+            all_works.extend(works)
+        projects = cls._get_work_projects(all_works)
+        super(Work, cls).write(*args)
+        projects |= cls._get_work_projects(all_works)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, works):
+        Summary = Pool().get('work.project.summary')
+        projects = cls._get_work_projects(works)
+        super(Work, cls).delete(works)
+        Summary.refresh(projects)
+
+
+class TimesheetLine:
+    __name__ = 'timesheet.line'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(TimesheetLine, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        # Labour expense of the projects is summed by work and date
+        table.index_action(['work', 'date'], 'add')
+
+    @classmethod
+    def _get_work_projects(cls, lines):
+        'Returns the ids of the projects related to the timesheet lines'
+        Work = Pool().get('timesheet.work')
+        return Work._get_work_projects(
+            list(set(l.work for l in cls.browse([l.id for l in lines]))))
+
+    @classmethod
+    def create(cls, vlist):
+        Summary = Pool().get('work.project.summary')
+        lines = super(TimesheetLine, cls).create(vlist)
+        Summary.refresh(cls._get_work_projects(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        all_lines = []
+        for lines, _ in zip(actions, actions):
+            all_lines.extend(lines)
+        projects = cls._get_work_projects(all_lines)
+        super(TimesheetLine, cls).write(*args)
+        projects |= cls._get_work_projects(all_lines)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, lines):
+        Summary = Pool().get('work.project.summary')
+        projects = cls._get_work_projects(lines)
+        super(TimesheetLine, cls).delete(lines)
+        Summary.refresh(projects)
@@ -1,47 +1,115 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import bisect
+import csv
+import datetime
+import tempfile
+import time
+from collections import defaultdict
 from decimal import Decimal
-from sql.aggregate import Max, Sum, Avg
-from sql.operators import NotIn
+from sql import Column, Null, Union, Literal, For
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.operators import Concat, Like, NotIn
 
-from trytond.model import ModelSQL, ModelView, fields
-from trytond.pyson import Eval, If
+from trytond import backend
+from trytond.config import config
+from trytond.ir.sequence import sql_sequence
+from trytond.model import Workflow, ModelSQL, ModelView, fields, Unique
+from trytond.report import Report
+from trytond.rpc import RPC
+from trytond.wizard import Wizard, StateView, StateReport, Button
+from trytond.pyson import Eval, If, Bool
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-from trytond.config import config
+from trytond.tools import reduce_ids, grouped_slice
 
 from trytond.modules.product import price_digits
 
-__all__ = ['ProjectSaleLine', 'Project', 'Sale']
+from .instrumentation import profile, cache_hits
+
+__all__ = ['ProjectSaleLine', 'Project', 'ProjectExportFinancialsStart',
+    'ProjectExportFinancials', 'ProjectFinancialsReport', 'Sale', 'SaleLine']
 
 __metaclass__ = PoolMeta
 
 _ZERO = Decimal('0.0')
+_CATEGORIES = ['labor', 'material', 'other']
+# Financial figures of the projects stored in work.project.summary
+SUMMARY_FIELDS = (['%s_%s' % (kind, category)
+            for kind in ('income', 'expense', 'margin', 'margin_percent')
+            for category in _CATEGORIES]
+    + ['invoiced_amount', 'amount_to_invoice'])
+KPI_FIELDS = SUMMARY_FIELDS + ['shipment_state']
+# Sales in those states are not aggregated in work.project.sale.line
+_SALE_EXCLUDED_STATES = ['cancel', 'draft', 'quotation']
+# Relations of the sales cached per project by Project._get_sale_graph
+_SALE_GRAPH_CACHE = 'work_project.sale_graph'
+_SALE_GRAPH_RELATIONS = ['sales', 'moves', 'shipments', 'shipment_returns',
+    'invoices']
+# Currency rates cached per date by Project._get_currency_rates
+_CURRENCY_RATES_CACHE = 'work_project.currency_rates'
+
+
+def _round_line(currency, quantity, unit_price, count=1):
+    '''
+    Returns the amount of count lines of quantity and unit price rounded one
+    by one with the currency as on the documents.
+    '''
+    if not isinstance(unit_price, Decimal):
+        unit_price = Decimal(str(unit_price or 0))
+    return currency.round(Decimal(str(quantity or 0)) * unit_price) * count
 
 
 class ProjectSaleLine(ModelSQL, ModelView):
     'Project Sale Line'
     __name__ = 'work.project.sale.line'
-    project = fields.Many2One('work.project', 'Project', required=True)
-    product = fields.Many2One('product.product', 'Product')
+    project = fields.Many2One('work.project', 'Project', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', readonly=True)
     quantity = fields.Float('Quantity',
-        digits=(16, Eval('unit_digits', 2)),
+        digits=(16, Eval('unit_digits', 2)), readonly=True,
         depends=['unit_digits'])
-    unit = fields.Many2One('product.uom', 'Unit')
+    unit = fields.Many2One('product.uom', 'Unit', readonly=True)
     unit_digits = fields.Function(fields.Integer('Unit Digits'),
         'on_change_with_unit_digits')
-    currency = fields.Many2One('currency.currency', 'Currency')
+    currency = fields.Many2One('currency.currency', 'Currency', readonly=True)
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
         'on_change_with_currency_digits')
-    unit_price = fields.Numeric('Unit Price', digits=price_digits)
-    amount = fields.Function(fields.Numeric('Amount',
-            digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']),
-        'get_amount')
+    unit_price = fields.Numeric('Unit Price', digits=price_digits,
+        readonly=True)
+    amount = fields.Numeric('Amount',
+        digits=(16, Eval('currency_digits', 2)), readonly=True,
+        depends=['currency_digits'])
+
+    @classmethod
+    def __setup__(cls):
+        super(ProjectSaleLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('group_unique', Unique(t, t.project, t.product, t.currency,
+                    t.unit),
+                'A project can have only one line per product, unit and '
+                'currency.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        # Migration from table query
+        created = not TableHandler.table_exist(cls._table)
+
+        super(ProjectSaleLine, cls).__register__(module_name)
 
-    def get_amount(self, name):
-        return self.currency.round(
-            Decimal(str(self.quantity)) * self.unit_price)
+        if created:
+            cursor.execute(*sale.select(sale.project,
+                    where=sale.project != Null,
+                    group_by=sale.project))
+            cls.update([p for p, in cursor.fetchall()])
 
     @fields.depends('unit')
     def on_change_with_unit_digits(self, name=None):
@@ -51,35 +119,116 @@ class ProjectSaleLine(ModelSQL, ModelView):
 
     @fields.depends('currency')
     def on_change_with_currency_digits(self, name=None):
-        return self.currency.digits
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+    @staticmethod
+    def _get_lines_where(line, sale):
+        'Returns the condition of the sale lines aggregated'
+        return ((line.type == 'line')
+            & (sale.project != Null)
+            & NotIn(sale.state, _SALE_EXCLUDED_STATES))
 
     @classmethod
-    def table_query(cls):
+    def _compute(cls, project_ids):
+        '''
+        Returns a dictionary with the values of the lines of the projects per
+        (project, product, currency, unit) computed from the sale lines.
+        '''
         pool = Pool()
         Sale = pool.get('sale.sale')
         SaleLine = pool.get('sale.line')
-        table = SaleLine.__table__()
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        line = SaleLine.__table__()
         sale = Sale.__table__()
+        exp = Decimal(1) / 10 ** price_digits[1]
 
-        columns = []
-        for name in ('id', 'create_uid', 'write_uid', 'create_date',
-                'write_date'):
-            columns.append(Max(getattr(table, name)).as_(name))
+        groups = {}
+        currencies = {}
+        for sub_ids in grouped_slice(project_ids):
+            # Lines are rounded one by one as on the sale so the identical
+            # lines are grouped
+            cursor.execute(*line.join(sale, condition=sale.id == line.sale
+                    ).select(sale.project, line.product, sale.currency,
+                    line.unit, line.quantity, line.unit_price,
+                    Count(Literal('*')),
+                    where=cls._get_lines_where(line, sale)
+                    & reduce_ids(sale.project, sub_ids),
+                    group_by=[sale.project, line.product, sale.currency,
+                        line.unit, line.quantity, line.unit_price]))
+            for (project_id, product_id, currency_id, unit_id, quantity,
+                    unit_price, count) in cursor.fetchall():
+                if currency_id not in currencies:
+                    currencies[currency_id] = Currency(currency_id)
+                key = (project_id, product_id, currency_id, unit_id)
+                values = groups.setdefault(key, {
+                        'quantity': 0.,
+                        'amount': _ZERO,
+                        'prices': _ZERO,
+                        'priced': 0,
+                        })
+                values['quantity'] += (quantity or 0.) * count
+                values['amount'] += _round_line(currencies[currency_id],
+                    quantity, unit_price, count)
+                if unit_price is not None:
+                    values['prices'] += Decimal(str(unit_price)) * count
+                    values['priced'] += count
+        for values in groups.itervalues():
+            prices, priced = values.pop('prices'), values.pop('priced')
+            values['unit_price'] = (
+                (prices / priced).quantize(exp) if priced else None)
+        return groups
 
-        columns.extend([sale.project, table.product, sale.currency, table.unit,
-                Sum(table.quantity).as_('quantity'),
-            Avg(table.unit_price).as_('unit_price')])
-
-        return table.join(sale, condition=(sale.id == table.sale)).select(
-            *columns,
-            where=((table.type == 'line') &
-                (sale.project != None) &
-                (NotIn(sale.state, ['cancel', 'draft', 'quotation']))
-                ),
-            group_by=(sale.project, sale.currency, table.product, table.unit))
+    @classmethod
+    def update(cls, projects):
+        '''
+        Synchronise the lines of the projects with their sale lines.
+        The line of a group keeps its id as long as the group has sale lines.
+        '''
+        Project = Pool().get('work.project')
+        project_ids = sorted(set(int(p) for p in projects))
+        if not project_ids:
+            return
+        # The sale users update the lines without access to them
+        with Transaction().set_context(_check_access=False):
+            # Skip the projects deleted in the same transaction
+            project_ids = [p.id for p in Project.search([
+                        ('id', 'in', project_ids),
+                        ])]
+            groups = cls._compute(project_ids)
+            to_delete, to_write = [], []
+            for line in cls.search([('project', 'in', project_ids)]):
+                key = (line.project.id, line.product and line.product.id,
+                    line.currency and line.currency.id,
+                    line.unit and line.unit.id)
+                values = groups.pop(key, None)
+                if values is None:
+                    to_delete.append(line)
+                elif any(getattr(line, n) != v
+                        for n, v in values.iteritems()):
+                    to_write.extend(([line], values))
+            if to_delete:
+                cls.delete(to_delete)
+            if to_write:
+                cls.write(*to_write)
+            to_create = []
+            for (project_id, product_id, currency_id, unit_id), values in (
+                    groups.iteritems()):
+                values = values.copy()
+                values.update({
+                        'project': project_id,
+                        'product': product_id,
+                        'currency': currency_id,
+                        'unit': unit_id,
+                        })
+                to_create.append(values)
+            if to_create:
+                cls.create(to_create)
 
 
-class Project(ModelSQL, ModelView):
+class Project(Workflow, ModelSQL, ModelView):
     'Work Project'
     __name__ = 'work.project'
     _rec_name = 'code'
@@ -114,77 +263,130 @@ class Project(ModelSQL, ModelView):
         'Sale Lines', readonly=True)
     supplier_invoice_lines = fields.One2Many('account.invoice.line',
         'work_project', 'Supplier Invoice Lines', domain=[
-            ('invoice.type', 'in', ['in_invoice', 'in_credit_note']),
+            ('invoice.type', '=', 'in'),
+            ],
+        filter=[
+            ('invoice.type', '=', 'in'),
             ])
     amount_to_invoice = fields.Function(fields.Numeric('Amount To Invoice',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_amount_to_invoice')
+        'get_amounts', searcher='search_amounts')
     invoiced_amount = fields.Function(fields.Numeric('Invoiced Amount',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_amount_to_invoice')
+        'get_amounts', searcher='search_amounts')
     shipments = fields.Function(fields.One2Many('stock.shipment.out',
-            None, 'Shipments'), 'get_shipments')
+            None, 'Shipments'), 'get_sale_relations')
     shipment_returns = fields.Function(fields.One2Many(
             'stock.shipment.out.return', None, 'Shipment Returns'),
-        'get_shipment_returns')
+        'get_sale_relations')
     moves = fields.Function(fields.One2Many('stock.move', None, 'Moves'),
-        'get_moves')
+        'get_sale_relations')
     income_labor = fields.Function(fields.Numeric('Income Labor',
         digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_income_labor')
+        'get_amounts', searcher='search_amounts')
     income_material = fields.Function(fields.Numeric('Income Material',
         digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_income_material')
+        'get_amounts', searcher='search_amounts')
     income_other = fields.Function(fields.Numeric('Income Other',
         digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_income_other')
+        'get_amounts', searcher='search_amounts')
+    expense_labor = fields.Function(fields.Numeric('Expense Labor',
+            digits=(16, Eval('currency_digits', 2)),
+            depends=['currency_digits']),
+        'get_amounts', searcher='search_amounts')
     expense_material = fields.Function(fields.Numeric('Expense Material',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_expense_material')
+        'get_amounts', searcher='search_amounts')
     expense_other = fields.Function(fields.Numeric('Expense Other',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_expense_other')
+        'get_amounts', searcher='search_amounts')
     margin_labor = fields.Function(fields.Numeric('Margin Labor',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     margin_material = fields.Function(fields.Numeric('Margin Material',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     margin_other = fields.Function(fields.Numeric('Margin Other',
             digits=(16, Eval('currency_digits', 2)),
             depends=['currency_digits']),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     margin_percent_labor = fields.Function(fields.Numeric('Margin(%) Labor',
             digits=(16, 4)),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     margin_percent_material = fields.Function(fields.Numeric(
             'Margin (%) Material', digits=(16, 4)),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     margin_percent_other = fields.Function(fields.Numeric('Margin (%) Other',
             digits=(16, 4)),
-        'get_margins')
+        'get_amounts', searcher='search_amounts')
     note = fields.Text('Note')
     invoices = fields.Function(fields.One2Many('account.invoice', None,
-        'Invoices'), 'get_invoices')
-    shipment_state = fields.Function(fields.Selection([
+        'Invoices'), 'get_sale_relations')
+    shipment_state = fields.Selection([
         ('exception', 'Exception'),
         ('sent', 'Sent'),
         ('partially sent', 'Partially sent'),
         ('waiting', 'Waiting'),
         ('none', 'None'),
-        ], 'Shipment State'), 
-        'get_shipment_state',
-        searcher='search_shipment_state_field'
-        )
+        ], 'Shipment State', readonly=True, select=True)
+    state = fields.Selection([
+            ('open', 'Open'),
+            ('closed', 'Closed'),
+            ], 'State', readonly=True, required=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Project, cls).__setup__()
+        cls._transitions |= set((
+                ('open', 'closed'),
+                ('closed', 'open'),
+                ))
+        cls._buttons.update({
+                'close': {
+                    'invisible': Eval('state') != 'open',
+                    },
+                'reopen': {
+                    'invisible': Eval('state') != 'closed',
+                    },
+                })
+        cls.__rpc__.update({
+                'get_kpis': RPC(),
+                })
+        cls._error_messages.update({
+                'unknown_kpi': 'The KPI "%(kpi)s" does not exist.',
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        table = TableHandler(cls, module_name)
+        # Migration from 4.8: shipment_state is stored
+        fill_shipment_state = not table.column_exist('shipment_state')
+
+        super(Project, cls).__register__(module_name)
+
+        if fill_shipment_state:
+            cursor = Transaction().connection.cursor()
+            sql_table = cls.__table__()
+            cursor.execute(*sql_table.select(sql_table.id))
+            cls.update_shipment_state([i for i, in cursor.fetchall()])
+
+    @staticmethod
+    def default_shipment_state():
+        return 'none'
+
+    @staticmethod
+    def default_state():
+        return 'open'
 
     @staticmethod
     def default_currency_digits():
@@ -200,9 +402,9 @@ class Project(ModelSQL, ModelView):
 
     @staticmethod
     def default_code_readonly():
-        Configuration = Pool().get('work.project.configuration')
-        config = Configuration(1)
-        return bool(config.project_sequence)
+        CompanyConfig = Pool().get('work.project.configuration.company')
+        values = CompanyConfig.get_values(Transaction().context.get('company'))
+        return bool(values.get('project_sequence'))
 
     @fields.depends('company')
     def on_change_with_currency_digits(self, name=None):
@@ -218,120 +420,772 @@ class Project(ModelSQL, ModelView):
         'Returns True if the sale line is of other type'
         return not line.product
 
-    def get_income_labor(self, name):
-        amount = _ZERO
-        for sale in self.sales:
-            for line in sale.lines:
-                if not self.is_other_line(line) and self.is_labour_line(line):
-                    amount += line.amount
-        return amount
-
-    def get_income_material(self, name):
-        amount = _ZERO
-        for sale in self.sales:
-            for line in sale.lines:
-                if (not self.is_other_line(line) and
-                        not self.is_labour_line(line)):
-                    amount += line.amount
-        return amount
-
-    def get_income_other(self, name):
-        amount = _ZERO
-        for sale in self.sales:
-            for line in sale.lines:
-                if self.is_other_line(line):
-                    amount += line.amount
-        return amount
-
-
-    def get_expense_material(self, name):
-        amount = _ZERO
-        for sale in self.sales:
-            for line in sale.lines:
-                if line.product and line.product.type != 'service':
-                    qty = Decimal(str(line.quantity or 0))
-                    # Compatibility with sale_margin
-                    if hasattr(line, 'cost_price'):
-                        cost_price = line.cost_price or _ZERO
+    def get_sale_line_category(self, line):
+        'Returns the category of the sale line using the Python hooks'
+        if self.is_other_line(line):
+            return 'other'
+        elif self.is_labour_line(line):
+            return 'labor'
+        return 'material'
+
+    @classmethod
+    def _sale_line_hooks_overridden(cls):
+        'Returns True if is_labour_line or is_other_line is overridden'
+        return any(getattr(cls, name).im_func is not func
+            for name, func in _SALE_LINE_HOOKS.iteritems())
+
+    @classmethod
+    def _sale_line_category_column(cls, line, template):
+        '''
+        Returns the SQL expression that classifies a sale line as 'labor',
+        'material' or 'other'.
+        It is the set-based counterpart of is_labour_line and is_other_line.
+        If only those are overridden, the lines are classified in Python.
+        '''
+        return Case((line.product == Null, 'other'),
+            (template.type == 'service', 'labor'),
+            else_='material')
+
+    @classmethod
+    def _get_sale_lines_where(cls, line, sale):
+        '''
+        Returns the SQL condition of the sale lines counted in the project
+        figures, whatever the state of their sale.
+        '''
+        return line.type == 'line'
+
+    @classmethod
+    def _join_sale_line_cost_price(cls, join, line, sale):
+        '''
+        Returns the join extended to get the cost price of the sale lines and
+        the column of the cost price.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        ProductCostPrice = pool.get('product.cost_price')
+        # Compatibility with sale_margin
+        if hasattr(SaleLine, 'cost_price'):
+            return join, line.cost_price
+        product_cost_price = ProductCostPrice.__table__()
+        join = join.join(product_cost_price, 'LEFT',
+            condition=(product_cost_price.product == line.product)
+            & (product_cost_price.company == sale.company))
+        return join, product_cost_price.cost_price
+
+    @classmethod
+    def _get_date_where(cls, column):
+        '''
+        Returns the condition of the date column within the from_date and
+        to_date of the context.
+        '''
+        context = Transaction().context
+        where = Literal(True)
+        if context.get('from_date'):
+            where &= column >= context['from_date']
+        if context.get('to_date'):
+            where &= column <= context['to_date']
+        return where
+
+    @classmethod
+    def _get_currency_rates(cls, keys):
+        '''
+        Returns a dictionary with the rate of each (currency id, date) of keys
+        or None if the currency has no rate at that date.
+        The rates are read with one query per slice of currencies and kept in
+        the transaction cache until a record is created, written or deleted.
+        '''
+        pool = Pool()
+        Rate = pool.get('currency.currency.rate')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        rate = Rate.__table__()
+
+        cache = transaction.cache.setdefault(_CURRENCY_RATES_CACHE, {})
+        key = (transaction.user, transaction.counter)
+        if key not in cache:
+            cache.clear()
+            cache[key] = {}
+        rates = cache[key]
+
+        keys = set(keys)
+        missing = defaultdict(set)
+        for currency_id, date in keys:
+            if (currency_id, date) not in rates:
+                missing[currency_id].add(date)
+        cache_hits(len(keys) - sum(len(d) for d in missing.itervalues()))
+        if missing:
+            max_date = max(max(d) for d in missing.itervalues())
+        for sub_ids in grouped_slice(list(missing)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*rate.select(rate.currency, rate.date, rate.rate,
+                    where=reduce_ids(rate.currency, sub_ids)
+                    & (rate.date <= max_date),
+                    order_by=[rate.currency, rate.date]))
+            history = defaultdict(lambda: ([], []))
+            for currency_id, date, value in cursor.fetchall():
+                dates, values = history[currency_id]
+                dates.append(date)
+                values.append(Decimal(str(value)))
+            for currency_id in sub_ids:
+                dates, values = history[currency_id]
+                for date in missing[currency_id]:
+                    # The rate applies from its date until the next one
+                    index = bisect.bisect_right(dates, date)
+                    rates[(currency_id, date)] = (
+                        values[index - 1] if index else None)
+        return dict((k, rates[k]) for k in keys)
+
+    @classmethod
+    def _sum_company_amounts(cls, projects, rows):
+        '''
+        Returns a dictionary with the sum of the amounts of rows by key
+        converted to the currency of the company of the project.
+        rows are tuples of key, project id, currency id, date and amount
+        rounded in its currency. The rate of the date, or of today if it is
+        empty, is used and all the rates are read in one batch.
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Date = pool.get('ir.date')
+        Lang = pool.get('ir.lang')
+        today = Date.today()
+
+        company_currencies = dict((p.id, p.company.currency) for p in projects)
+        rows = [(key, project_id, currency_id, date or today, amount)
+            for key, project_id, currency_id, date, amount in rows]
+        keys = set()
+        for _, project_id, currency_id, date, _ in rows:
+            to_currency = company_currencies[project_id]
+            if currency_id != to_currency.id:
+                keys.add((currency_id, date))
+                keys.add((to_currency.id, date))
+        rates = cls._get_currency_rates(keys)
+
+        amounts = defaultdict(lambda: _ZERO)
+        for key, project_id, currency_id, date, amount in rows:
+            to_currency = company_currencies[project_id]
+            if currency_id != to_currency.id:
+                from_rate = rates[(currency_id, date)]
+                to_rate = rates[(to_currency.id, date)]
+                if not from_rate or not to_rate:
+                    currency = (Currency(currency_id) if not from_rate
+                        else to_currency)
+                    language, = Lang.search([
+                            ('code', '=', Transaction().language),
+                            ])
+                    Currency.raise_user_error('no_rate', {
+                            'currency': currency.name,
+                            'date': date.strftime(str(language.date)),
+                            })
+                amount = to_currency.round(amount * to_rate / from_rate)
+            amounts[key] += amount
+        return amounts
+
+    @classmethod
+    def _get_sale_amounts(cls, projects):
+        '''
+        Returns a dictionary with the income per category and the material
+        expense of the sale lines of each project, computed with one grouped
+        query per slice of projects.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        join = line.join(sale, condition=sale.id == line.sale
+            ).join(product, 'LEFT', condition=product.id == line.product
+            ).join(template, 'LEFT', condition=template.id == product.template)
+        join, cost_price = cls._join_sale_line_cost_price(join, line, sale)
+
+        amounts = dict((p.id, {
+                    'income_labor': _ZERO,
+                    'income_material': _ZERO,
+                    'income_other': _ZERO,
+                    'expense_material': _ZERO,
+                    }) for p in projects)
+        currencies = {}
+        rows = []
+        # Each line is returned to be classified by the Python hooks
+        classify = cls._sale_line_hooks_overridden()
+        if classify:
+            category = line.id
+            id2project = dict((p.id, p) for p in projects)
+        else:
+            category = cls._sale_line_category_column(line, template)
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            # Classify in a sub-query so the category can be grouped by name
+            lines = join.select(sale.project, sale.currency,
+                sale.sale_date.as_('date'), category.as_('category'),
+                line.quantity, line.unit_price, cost_price.as_('cost_price'),
+                where=cls._get_sale_lines_where(line, sale)
+                & reduce_ids(sale.project, sub_ids)
+                & cls._get_date_where(sale.sale_date))
+            # Lines are rounded one by one as on the sale so the identical
+            # lines are grouped
+            cursor.execute(*lines.select(lines.project, lines.currency,
+                    lines.date, lines.category, lines.quantity,
+                    lines.unit_price, lines.cost_price, Count(Literal('*')),
+                    group_by=[lines.project, lines.currency, lines.date,
+                        lines.category, lines.quantity, lines.unit_price,
+                        lines.cost_price]))
+            results = cursor.fetchall()
+            if classify:
+                sale_lines = dict((l.id, l)
+                    for l in SaleLine.browse([r[3] for r in results]))
+            for (project_id, currency_id, date, category, quantity,
+                    unit_price, cost_price_, count) in results:
+                if classify:
+                    category = id2project[project_id].get_sale_line_category(
+                        sale_lines[category])
+                if currency_id not in currencies:
+                    currencies[currency_id] = Currency(currency_id)
+                currency = currencies[currency_id]
+                rows.append(((project_id, 'income_%s' % category),
+                        project_id, currency_id, date,
+                        _round_line(currency, quantity, unit_price, count)))
+                if category == 'material':
+                    rows.append(((project_id, 'expense_material'),
+                            project_id, currency_id, date,
+                            _round_line(currency, quantity, cost_price_,
+                                count)))
+        for (project_id, name), amount in cls._sum_company_amounts(
+                projects, rows).iteritems():
+            amounts[project_id][name] = amount
+        return amounts
+
+    @classmethod
+    def _get_timesheet_works_query(cls, project_ids=None):
+        '''
+        Returns a query with the timesheet works whose origin is a sale or a
+        sale line of the projects, or of any project if project_ids is None,
+        with their project.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Work = pool.get('timesheet.work')
+        work = Work.__table__()
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        line_work = Work.__table__()
+        line_sale = Sale.__table__()
+
+        if project_ids is None:
+            sale_where = sale.project != Null
+            line_where = line_sale.project != Null
+        else:
+            sale_where = reduce_ids(sale.project, project_ids)
+            line_where = reduce_ids(line_sale.project, project_ids)
+        sale_works = work.join(sale,
+            condition=work.origin == Concat(Sale.__name__ + ',', sale.id)
+            ).select(work.id.as_('work'), sale.project.as_('project'),
+            where=sale_where)
+        line_works = line_work.join(line,
+            condition=line_work.origin == Concat(
+                SaleLine.__name__ + ',', line.id)
+            ).join(line_sale, condition=line_sale.id == line.sale
+            ).select(line_work.id.as_('work'),
+            line_sale.project.as_('project'),
+            where=line_where)
+        return Union(sale_works, line_works, all_=True)
+
+    @classmethod
+    def _get_timesheet_costs(cls, projects):
+        '''
+        Returns a dictionary with the cost of the timesheet lines of the works
+        of each project.
+        The durations are summed in SQL by cost price over the lines within
+        the dates of the context, which are indexed by work and date.
+        '''
+        pool = Pool()
+        TimesheetLine = pool.get('timesheet.line')
+        cursor = Transaction().connection.cursor()
+        timesheet = TimesheetLine.__table__()
+
+        costs = dict((p.id, _ZERO) for p in projects)
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            works = cls._get_timesheet_works_query(list(sub_ids))
+            cursor.execute(*timesheet.join(works,
+                    condition=timesheet.work == works.work
+                    ).select(works.project, timesheet.cost_price,
+                    Sum(timesheet.duration),
+                    where=cls._get_date_where(timesheet.date),
+                    group_by=[works.project, timesheet.cost_price]))
+            for project_id, cost_price, duration in cursor.fetchall():
+                # Durations are summed as intervals or as seconds
+                if isinstance(duration, datetime.timedelta):
+                    duration = duration.total_seconds()
+                hours = Decimal(str(duration or 0)) / 3600
+                costs[project_id] += hours * Decimal(str(cost_price or 0))
+        for project in projects:
+            costs[project.id] = project.company.currency.round(
+                costs[project.id])
+        return costs
+
+    @classmethod
+    def _get_supplier_invoice_amounts(cls, projects):
+        '''
+        Returns a dictionary with the untaxed amount of the supplier invoice
+        lines of each project.
+        Cancelled invoices are ignored and credit notes are deducted.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        invoice = Invoice.__table__()
+        line = InvoiceLine.__table__()
+
+        amounts = dict((p.id, _ZERO) for p in projects)
+        currencies = {}
+        rows = []
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            # Lines are rounded one by one as on the invoice so the identical
+            # lines are grouped
+            cursor.execute(*line.join(invoice,
+                    condition=invoice.id == line.invoice
+                    ).select(line.work_project, invoice.currency,
+                    invoice.invoice_date, line.quantity, line.unit_price,
+                    Count(Literal('*')),
+                    where=reduce_ids(line.work_project, sub_ids)
+                    & (line.type == 'line')
+                    & (invoice.type == 'in')
+                    & (invoice.state != 'cancel')
+                    & cls._get_date_where(invoice.invoice_date),
+                    group_by=[line.work_project, invoice.currency,
+                        invoice.invoice_date, line.quantity,
+                        line.unit_price]))
+            for (project_id, currency_id, date, quantity, unit_price,
+                    count) in cursor.fetchall():
+                if currency_id not in currencies:
+                    currencies[currency_id] = Currency(currency_id)
+                rows.append((project_id, project_id, currency_id, date,
+                        _round_line(currencies[currency_id], quantity,
+                            unit_price, count)))
+        amounts.update(cls._sum_company_amounts(projects, rows))
+        return amounts
+
+    @classmethod
+    def _get_invoiced_amounts(cls, projects):
+        '''
+        Returns a dictionary with the untaxed amount invoiced from the sales
+        of each project in the currency of its company.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        query = Sale._get_invoiced_lines_query()
+
+        amounts = dict((p.id, _ZERO) for p in projects)
+        currencies = {}
+        rows = []
+        for sub_ids in grouped_slice([p.id for p in projects]):
+            cursor.execute(*query.select(query.project, query.currency,
+                    query.date, query.quantity, query.unit_price,
+                    Count(Literal('*')),
+                    where=reduce_ids(query.project, sub_ids)
+                    & cls._get_date_where(query.date),
+                    group_by=[query.project, query.currency, query.date,
+                        query.quantity, query.unit_price]))
+            for (project_id, currency_id, date, quantity, unit_price,
+                    count) in cursor.fetchall():
+                if currency_id not in currencies:
+                    currencies[currency_id] = Currency(currency_id)
+                rows.append((project_id, project_id, currency_id, date,
+                        _round_line(currencies[currency_id], quantity,
+                            unit_price, count)))
+        amounts.update(cls._sum_company_amounts(projects, rows))
+        return amounts
+
+    @classmethod
+    def _get_income_expense(cls, projects):
+        '''
+        Returns a dictionary with the income and expense of every category
+        for each project.
+        '''
+        amounts = {}
+        for project in projects:
+            amounts[project.id] = dict(('%s_%s' % (kind, category), _ZERO)
+                for kind in ('income', 'expense')
+                for category in _CATEGORIES)
+        for project_id, values in cls._get_sale_amounts(projects).iteritems():
+            amounts[project_id].update(values)
+        for project_id, amount in cls._get_timesheet_costs(
+                projects).iteritems():
+            amounts[project_id]['expense_labor'] = amount
+        for project_id, amount in cls._get_supplier_invoice_amounts(
+                projects).iteritems():
+            amounts[project_id]['expense_other'] = amount
+        return amounts
+
+    @classmethod
+    def _get_margins(cls, projects, amounts):
+        '''
+        Returns a dictionary with the margin and margin percent of every
+        category for each project, derived from its income and expense.
+        '''
+        margins = {}
+        for project in projects:
+            values = amounts[project.id]
+            margins[project.id] = {}
+            for category in _CATEGORIES:
+                income = values['income_%s' % category]
+                expense = values['expense_%s' % category]
+                for name in ('margin_%s' % category,
+                        'margin_percent_%s' % category):
+                    if 'percent' in name:
+                        if not expense:
+                            value = Decimal('1.0')
+                        else:
+                            value = (income - expense) / expense
+                        digits = getattr(cls, name).digits[1]
                     else:
-                        cost_price = line.product.cost_price
-                    amount += sale.currency.round(cost_price * qty)
-        return amount
+                        value = income - expense
+                        digits = project.currency_digits
+                    value = value.quantize(Decimal(str(10 ** - digits)))
+                    margins[project.id][name] = value
+        return margins
 
-    def get_expense_other(self, name):
-        amount = _ZERO
-        return amount
+    @classmethod
+    def _compute_amounts(cls, projects):
+        '''
+        Returns a dictionary with the financial figures of each project
+        computed live from its sales and invoices.
+        The records are limited to the from_date and to_date of the context.
+        '''
+        amounts = cls._get_income_expense(projects)
+        margins = cls._get_margins(projects, amounts)
+        invoiced_amounts = cls._get_invoiced_amounts(projects)
+        for project in projects:
+            values = amounts[project.id]
+            values.update(margins[project.id])
+            # The income of all categories is the untaxed amount of the sales
+            untaxed_amount = sum((values['income_%s' % c]
+                    for c in _CATEGORIES), Decimal('0.00'))
+            values['invoiced_amount'] = invoiced_amounts[project.id]
+            values['amount_to_invoice'] = (
+                untaxed_amount - invoiced_amounts[project.id])
+        return amounts
 
     @classmethod
-    def get_margins(cls, projects, names):
+    @profile
+    def get_amounts(cls, projects, names):
+        Summary = Pool().get('work.project.summary')
+        amounts = Summary.get_amounts(projects)
         res = {}
         for name in names:
-            res[name] = dict((p.id, _ZERO) for p in projects)
-        for project in projects:
-            for name in names:
-                field_name = name.split('_')[-1]
-                income = getattr(project, 'income_%s' % field_name)
-                expense = getattr(project, 'expense_%s' % field_name)
-                if 'percent' in name:
-                    if not expense:
-                        value = Decimal('1.0')
-                    else:
-                        value = (income - expense) / expense
-                    digits = getattr(cls, name).digits[1]
-                else:
-                    value = income - expense
-                    digits = project.currency_digits
-                value = value.quantize(Decimal(str(10 ** - digits)))
-                res[name][project.id] = value
+            res[name] = dict((p.id, amounts[p.id][name]) for p in projects)
         return res
 
     @classmethod
-    def get_amount_to_invoice(cls, projects, names):
-        res = {}
+    def iter_financials(cls, projects, chunk_size=None):
+        '''
+        Yields the code, the party and the financial figures of each project.
+        The projects are read by chunks so only one chunk of records is kept
+        in memory.
+        '''
+        Summary = Pool().get('work.project.summary')
+        for sub_ids in grouped_slice([p.id for p in projects], chunk_size):
+            sub_projects = cls.browse(list(sub_ids))
+            amounts = Summary.get_amounts(sub_projects)
+            for project in sub_projects:
+                values = amounts[project.id]
+                yield ([project.code, project.party.rec_name]
+                    + [values[name] for name in SUMMARY_FIELDS])
+
+    @classmethod
+    def write_financials_csv(cls, projects, file_, chunk_size=None):
+        'Writes the financial figures of the projects as CSV into file_'
+        def encode(value):
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return value
+        writer = csv.writer(file_)
+        writer.writerow([encode(n) for n in [cls.code.string,
+                    cls.party.string]
+                + [getattr(cls, n).string for n in SUMMARY_FIELDS]])
+        for row in cls.iter_financials(projects, chunk_size=chunk_size):
+            writer.writerow([encode(v) for v in row])
+
+    @classmethod
+    def get_kpis(cls, domain, names=None, limit=None, offset=0,
+            totals=False):
+        '''
+        Returns a dictionary with the ids of the projects matching domain and
+        a list of values for each KPI of names, in the same order, or all of
+        them if names is empty.
+        If totals is set, the dictionary has also the totals of the amounts
+        over all the projects of the domain, regardless of limit and offset,
+        and the margin percents computed from them.
+        The amounts and the totals are restricted to the dates of the context.
+        '''
+        pool = Pool()
+        Summary = pool.get('work.project.summary')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        summary = Summary.__table__()
+
+        names = names or KPI_FIELDS
         for name in names:
-            res[name] = dict((p.id, _ZERO) for p in projects)
+            if name not in KPI_FIELDS:
+                cls.raise_user_error('unknown_kpi', {
+                        'kpi': name,
+                        })
+        projects = cls.search(domain, offset=offset, limit=limit)
+        ids = [p.id for p in projects]
+        amounts = Summary.get_amounts(projects)
+        shipment_states = {}
+        if 'shipment_state' in names:
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.select(table.id, table.shipment_state,
+                        where=reduce_ids(table.id, sub_ids)))
+                shipment_states.update(cursor.fetchall())
 
-        for project in projects:
-            amount_to_invoice = Decimal('0.00')
-            invoiced_amount = Decimal('0.00')
-            for sale in project.sales:
-                amount_to_invoice += sale.amount_to_invoice()
-                invoiced_amount += sale.invoiced_amount()
-            res['amount_to_invoice'][project.id] = amount_to_invoice
-            res['invoiced_amount'][project.id] = invoiced_amount
+        res = {'ids': ids}
+        for name in names:
+            if name == 'shipment_state':
+                res[name] = [shipment_states[i] for i in ids]
+            else:
+                res[name] = [amounts[i][name] for i in ids]
+        if not totals:
+            return res
+
+        sum_names = [n for n in SUMMARY_FIELDS
+            if not n.startswith('margin_percent_')]
+        context = Transaction().context
+        if context.get('from_date') or context.get('to_date'):
+            # The stored summary covers all dates so the totals are computed
+            # live like the amounts
+            total = dict((n, _ZERO) for n in sum_names)
+            all_ids = [p.id for p in cls.search(domain, order=[])]
+            for sub_ids in grouped_slice(all_ids):
+                for values in Summary.get_amounts(
+                        cls.browse(sub_ids)).itervalues():
+                    for name in sum_names:
+                        total[name] += values[name]
+        else:
+            query = cls.search(domain, order=[], query=True)
+            cursor.execute(*summary.select(
+                    *[Sum(Column(summary, n)) for n in sum_names],
+                    where=summary.project.in_(query)))
+            row = cursor.fetchone()
+            total = dict((n, Decimal(str(v or 0)))
+                for n, v in zip(sum_names, row))
+            # The projects without summary are computed live
+            cursor.execute(*table.select(table.id,
+                    where=table.id.in_(query)
+                    & NotIn(table.id, summary.select(summary.project))))
+            missing = [i for i, in cursor.fetchall()]
+            if missing:
+                for values in cls._compute_amounts(
+                        cls.browse(missing)).itervalues():
+                    for name in sum_names:
+                        total[name] += values[name]
+        for category in _CATEGORIES:
+            name = 'margin_percent_%s' % category
+            income = total['income_%s' % category]
+            expense = total['expense_%s' % category]
+            value = (income - expense) / expense if expense else Decimal('1.0')
+            digits = getattr(cls, name).digits[1]
+            total[name] = value.quantize(Decimal(str(10 ** - digits)))
+        res['totals'] = dict((n, total[n]) for n in names if n in total)
         return res
 
     def get_code_readonly(self, name):
         return True
 
-    def get_moves(self, name):
-        return [m.id for s in self.sales for m in s.moves]
+    @classmethod
+    def _get_sale_relation_query(cls, name):
+        '''
+        Returns a query with the project and the id of the records of the
+        sale relation name: sales, moves, shipments, shipment_returns or
+        invoices.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Move = pool.get('stock.move')
+        InvoiceLine = pool.get('account.invoice.line')
+        sale = Sale.__table__()
+        move = Move.__table__()
+        invoice_line = InvoiceLine.__table__()
 
-    def get_shipments(self, name):
-        return [m.id for s in self.sales for m in s.shipments]
+        if name == 'sales':
+            return sale.select(sale.project, sale.id.as_('id'))
+        if name == 'invoices':
+            # The supplier lines are also linked to projects but have no
+            # sale line origin
+            return invoice_line.select(
+                invoice_line.work_project.as_('project'),
+                invoice_line.invoice.as_('id'),
+                where=(invoice_line.work_project != Null)
+                & (invoice_line.invoice != Null)
+                & Like(invoice_line.origin, SaleLine.__name__ + ',%'))
+        if name == 'moves':
+            return move.select(move.work_project.as_('project'),
+                move.id.as_('id'),
+                where=move.work_project != Null)
+        Shipment = pool.get({
+                'shipments': 'stock.shipment.out',
+                'shipment_returns': 'stock.shipment.out.return',
+                }[name])
+        shipment = Shipment.__table__()
+        return move.join(shipment,
+            condition=move.shipment == Concat(
+                Shipment.__name__ + ',', shipment.id)
+            ).select(move.work_project.as_('project'), shipment.id.as_('id'),
+            where=move.work_project != Null)
 
-    def get_shipment_returns(self, name):
-        return [m.id for s in self.sales for m in s.shipment_returns]
+    @classmethod
+    def _get_sale_graph(cls, projects, names=None):
+        '''
+        Returns a dictionary with the ids of the records of the sale relations
+        names, all by default, for each project.
+        Each relation is read with one query per slice of projects and kept
+        in the transaction cache until a record is created, written or
+        deleted.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        if names is None:
+            names = _SALE_GRAPH_RELATIONS
 
-    def get_invoices(self, name):
-        return [m.id for s in self.sales for m in s.invoices]
+        cache = transaction.cache.setdefault(_SALE_GRAPH_CACHE, {})
+        key = (transaction.user, transaction.counter)
+        if key not in cache:
+            cache.clear()
+            cache[key] = {}
+        graph = cache[key]
+        for project in projects:
+            graph.setdefault(project.id, {})
+
+        for name in names:
+            missing = [p.id for p in projects if name not in graph[p.id]]
+            cache_hits(len(projects) - len(missing))
+            for project_id in missing:
+                graph[project_id][name] = []
+            query = cls._get_sale_relation_query(name)
+            for sub_ids in grouped_slice(missing):
+                # Group to remove the duplicates of records shared by lines
+                # or sales
+                cursor.execute(*query.select(query.project, query.id,
+                        where=reduce_ids(query.project, sub_ids),
+                        group_by=[query.project, query.id],
+                        order_by=[query.project, query.id]))
+                for project_id, record_id in cursor.fetchall():
+                    graph[project_id][name].append(record_id)
+        return dict((p.id, dict((n, graph[p.id][n]) for n in names))
+            for p in projects)
+
+    @classmethod
+    @profile
+    def get_sale_relations(cls, projects, names):
+        graph = cls._get_sale_graph(projects, names)
+        res = {}
+        for name in names:
+            res[name] = dict((p.id, graph[p.id][name]) for p in projects)
+        return res
 
     @classmethod
     def create(cls, vlist):
         'Fill the reference field with the sale sequence'
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
-        Config = pool.get('work.project.configuration')
+        CompanyConfig = pool.get('work.project.configuration.company')
+        Summary = pool.get('work.project.summary')
 
-        config = Config(1)
+        default_company = cls.default_company()
+        to_number = defaultdict(list)
+        vlist = [v.copy() for v in vlist]
         for value in vlist:
             if not value.get('code'):
-                if config.project_sequence:
-                    code = Sequence.get_id(config.project_sequence.id)
-                else:
-                    code = None
+                sequence_id = CompanyConfig.get_values(
+                    value.get('company', default_company)).get(
+                    'project_sequence')
+                value['code'] = None
+                if sequence_id:
+                    to_number[sequence_id].append(value)
+        for sequence_id, values in to_number.iteritems():
+            codes = cls._allocate_codes(sequence_id, len(values))
+            for value, code in zip(values, codes):
                 value['code'] = code
-        return super(Project, cls).create(vlist)
+        projects = super(Project, cls).create(vlist)
+        Summary.refresh(projects)
+        return projects
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('work.project.summary')
+        actions = iter(args)
+        to_refresh = []
+        for projects, values in zip(actions, actions):
+            # The amounts are converted to the currency of the company
+            if 'company' in values:
+                to_refresh.extend(projects)
+        super(Project, cls).write(*args)
+        Summary.refresh(to_refresh)
+
+    @classmethod
+    def _allocate_codes(cls, sequence_id, count):
+        '''
+        Returns count codes of the sequence in order.
+        The numbers of incremental sequences are reserved at once, other
+        sequences are called once per code.
+        '''
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        transaction = Transaction()
+        database = transaction.database
+        connection = transaction.connection
+        cursor = connection.cursor()
+
+        # Bypass rules on sequences as Sequence.get_id
+        with transaction.set_context(user=False, _check_access=False), \
+                transaction.set_user(0):
+            sequence = Sequence(sequence_id)
+            if sequence.type != 'incremental':
+                return [Sequence.get_id(sequence_id) for _ in range(count)]
+
+            if sql_sequence:
+                cursor.execute('SELECT nextval(\'"%s"\') '
+                    'FROM generate_series(1, %%s)'
+                    % sequence._sql_sequence_name, (count,))
+                numbers = [n for n, in cursor.fetchall()]
+            else:
+                if not database.has_select_for():
+                    database.lock(connection, Sequence._table)
+                else:
+                    table = Sequence.__table__()
+                    cursor.execute(*table.select(Literal(1),
+                            where=table.id == sequence.id,
+                            for_=For('UPDATE')))
+                # Read the number once the row is locked, bypassing the
+                # values cached by the instance
+                values, = Sequence.read([sequence_id],
+                    ['number_next_internal', 'number_increment'])
+                number_next = values['number_next_internal']
+                increment = values['number_increment']
+                Sequence.write([sequence], {
+                        'number_next_internal': (
+                            number_next + count * increment),
+                        })
+                numbers = range(number_next, number_next + count * increment,
+                    increment)
+
+            date = transaction.context.get('date')
+            prefix = Sequence._process(sequence.prefix, date=date)
+            suffix = Sequence._process(sequence.suffix, date=date)
+            return ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % n,
+                    suffix) for n in numbers]
 
     @classmethod
     def copy(cls, projects, default=None):
@@ -342,43 +1196,322 @@ class Project(ModelSQL, ModelView):
         return super(Project, cls).copy(projects, default=default)
 
     @classmethod
-    def get_shipment_state(cls, records, _):
+    @profile
+    def search_amounts(cls, name, clause):
+        pool = Pool()
+        Summary = pool.get('work.project.summary')
+        project = cls.__table__()
+        summary = Summary.__table__()
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        field = Summary._fields[name]
+        # Projects without summary have no sales nor invoices
+        # The stored summary covers all dates whatever the context
+        default = 1 if name.startswith('margin_percent_') else 0
+        column = Coalesce(field.sql_column(summary), default)
+        query = project.join(summary, 'LEFT',
+            condition=summary.project == project.id
+            ).select(project.id,
+                where=Operator(column, field._domain_value(operator, value)))
+        return [('id', 'in', query)]
+
+    def _order_summary_field(name):
+        def order_field(tables):
+            pool = Pool()
+            Summary = pool.get('work.project.summary')
+            field = Summary._fields[name]
+            table, _ = tables[None]
+            summary_tables = tables.get('summary')
+            if summary_tables is None:
+                summary = Summary.__table__()
+                summary_tables = {
+                    None: (summary, summary.project == table.id),
+                    }
+                tables['summary'] = summary_tables
+            return field.convert_order(name, summary_tables, Summary)
+        return staticmethod(order_field)
+    order_income_labor = _order_summary_field('income_labor')
+    order_income_material = _order_summary_field('income_material')
+    order_income_other = _order_summary_field('income_other')
+    order_expense_material = _order_summary_field('expense_material')
+    order_expense_labor = _order_summary_field('expense_labor')
+    order_expense_other = _order_summary_field('expense_other')
+    order_margin_labor = _order_summary_field('margin_labor')
+    order_margin_material = _order_summary_field('margin_material')
+    order_margin_other = _order_summary_field('margin_other')
+    order_margin_percent_labor = _order_summary_field('margin_percent_labor')
+    order_margin_percent_material = _order_summary_field(
+        'margin_percent_material')
+    order_margin_percent_other = _order_summary_field('margin_percent_other')
+    order_invoiced_amount = _order_summary_field('invoiced_amount')
+    order_amount_to_invoice = _order_summary_field('amount_to_invoice')
+
+    @classmethod
+    def _get_shipment_state_query(cls):
         '''
-        Return the shipment state for the sale.
+        Returns a query with the shipment state of each project computed
+        from the shipment state of its sales.
         '''
-        res = {}
-        for project in records:
-            sales = project.sales
-            if sales:
-                if any(s.shipment_state == 'exception' for s in sales):
-                   res[project.id] = 'exception'
-                elif all(s.shipment_state == 'sent' for s in sales):
-                    res[project.id] = 'sent'
-                elif any(s.shipment_state == 'sent' for s in sales):
-                    res[project.id] = 'partially sent'
-                else:
-                    res[project.id] = 'waiting'
-            else:
-                res[project.id] = 'none'
-        return res
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        project = cls.__table__()
+        sale = Sale.__table__()
+
+        def count(state):
+            return Sum(Case((sale.shipment_state == state, 1), else_=0))
+
+        shipment_state = Case(
+            (Count(sale.id) == 0, 'none'),
+            (count('exception') > 0, 'exception'),
+            (count('sent') == Count(sale.id), 'sent'),
+            (count('sent') > 0, 'partially sent'),
+            else_='waiting')
+        return project.join(sale, 'LEFT',
+            condition=sale.project == project.id
+            ).select(project.id.as_('project'),
+                shipment_state.as_('shipment_state'),
+                group_by=project.id)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('closed')
+    def close(cls, projects):
+        '''
+        Store the final financial figures and shipment state of the projects
+        which are no more recomputed until they are reopened.
+        '''
+        Summary = Pool().get('work.project.summary')
+        cls.update_shipment_state([p.id for p in projects])
+        Summary.refresh(projects)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('open')
+    def reopen(cls, projects):
+        'Discard the stored figures of the projects by recomputing them'
+        Summary = Pool().get('work.project.summary')
+        # The state must be written before so the projects are refreshed
+        cls.write(projects, {'state': 'open'})
+        cls.update_shipment_state([p.id for p in projects])
+        Summary.refresh(projects)
+
+    @classmethod
+    def recompute_metrics(cls, chunk_size=None):
+        '''
+        Recompute the figures and the shipment state of the open projects by
+        chunks of chunk_size ids, each in its own transaction.
+        The unfinished run is resumed and several workers can run at once
+        as the chunk locked by a worker is skipped by the others.
+        The skipped chunks are revisited by another pass and the run is
+        finished only once a pass skipped none. If a pass recomputed
+        nothing, the run is left open for the next call.
+        '''
+        pool = Pool()
+        Run = pool.get('work.project.summary.run')
+        transaction = Transaction()
+        if chunk_size is None:
+            chunk_size = config.getint('work_project', 'recompute_chunk_size',
+                default=500)
+
+        with transaction.new_transaction():
+            run = Run.get_current()
+            run_id, cutoff = run.id, run.cutoff
+        while True:
+            skipped, recomputed = False, False
+            last_id = 0
+            while last_id is not None:
+                start = time.time()
+                with transaction.new_transaction():
+                    last_id, count = cls._recompute_chunk(
+                        cutoff, last_id, chunk_size)
+                    if count:
+                        Run.add_progress(run_id, count, time.time() - start)
+                if count:
+                    recomputed = True
+                elif last_id is not None:
+                    skipped = True
+            if not skipped:
+                break
+            elif not recomputed:
+                return
+        with transaction.new_transaction():
+            Run.finish(run_id)
 
     @classmethod
-    def search_shipment_state_field(cls, name, clause):
-        shipment_state_filter = clause[2]
-        projects = cls.search([])
-        projects_shipment_state_dict = Project.get_shipment_state(projects, name)
-        filtered_projects = [p.id for p in projects if projects_shipment_state_dict[p.id] == shipment_state_filter]
-        if clause[1] == '=':
-            return ['id', 'in', filtered_projects]
-        elif clause[1] == '!=':
-            return ['id', 'not in', filtered_projects]
+    def _recompute_chunk(cls, cutoff, last_id, chunk_size):
+        '''
+        Recompute the next chunk of open projects after last_id which are
+        not computed since cutoff.
+        Returns the last id of the chunk, or None if there are no more
+        projects, and the number of projects recomputed.
+        A chunk locked by another worker is skipped and reported with no
+        project recomputed, but a chunk committed meanwhile may be recomputed
+        again.
+        On SQLite, which has no row lock, the table lock is a no-op and the
+        chunks are serialised by the lock of the whole database taken by the
+        writes, so no chunk is skipped.
+        '''
+        pool = Pool()
+        Summary = pool.get('work.project.summary')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        summary = Summary.__table__()
+
+        cursor.execute(*table.join(summary, 'LEFT',
+                condition=summary.project == table.id
+                ).select(table.id,
+                where=(table.id > last_id)
+                & (table.state == 'open')
+                & ((summary.id == Null) | (summary.compute_date < cutoff)),
+                order_by=[table.id.asc],
+                limit=chunk_size))
+        ids = [i for i, in cursor.fetchall()]
+        if not ids:
+            return None, 0
+        if database.has_select_for():
+            try:
+                cursor.execute(*table.select(Literal(1),
+                        where=reduce_ids(table.id, ids),
+                        for_=For('UPDATE', nowait=True)))
+            except DatabaseOperationalError:
+                transaction.rollback()
+                return ids[-1], 0
         else:
-            return None
+            database.lock(transaction.connection, cls._table)
+        cls.update_shipment_state(ids)
+        Summary.refresh(ids)
+        return ids[-1], len(ids)
+
+    @classmethod
+    def update_shipment_state(cls, project_ids):
+        '''
+        Store the shipment state computed from the sales of the projects.
+        The state of the closed projects is kept.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        query = cls._get_shipment_state_query()
+
+        to_write = defaultdict(list)
+        for sub_ids in grouped_slice(list(project_ids)):
+            cursor.execute(*query.join(table,
+                    condition=table.id == query.project
+                    ).select(query.project, query.shipment_state,
+                    where=reduce_ids(query.project, sub_ids)
+                    & (table.state == 'open')
+                    & ((table.shipment_state != query.shipment_state)
+                        | (table.shipment_state == Null))))
+            for project_id, state in cursor.fetchall():
+                to_write[state].append(project_id)
+        # Write only the changed projects, grouped by state
+        args = []
+        for state, ids in to_write.iteritems():
+            args.extend((cls.browse(ids), {'shipment_state': state}))
+        if args:
+            # The state follows the sales of any user
+            with Transaction().set_context(_check_access=False):
+                cls.write(*args)
+
+
+# The classification hooks of Project to detect their overrides
+_SALE_LINE_HOOKS = dict((n, getattr(Project, n).im_func)
+    for n in ['is_labour_line', 'is_other_line'])
+
+
+class ProjectExportFinancialsStart(ModelView):
+    'Export Work Project Financials'
+    __name__ = 'work.project.export_financials.start'
+    selected = fields.Boolean('Selected Projects',
+        help="Export only the selected projects.")
+    party = fields.Many2One('party.party', 'Party',
+        states={
+            'invisible': Bool(Eval('selected')),
+            },
+        depends=['selected'])
+    state = fields.Selection([
+            (None, ''),
+            ('open', 'Open'),
+            ('closed', 'Closed'),
+            ], 'State',
+        states={
+            'invisible': Bool(Eval('selected')),
+            },
+        depends=['selected'])
+
+    @staticmethod
+    def default_selected():
+        return bool(Transaction().context.get('active_ids'))
+
+    def get_domain(self):
+        'Returns the domain of the projects to export'
+        domain = []
+        if self.party:
+            domain.append(('party', '=', self.party.id))
+        if self.state:
+            domain.append(('state', '=', self.state))
+        return domain
+
+
+class ProjectExportFinancials(Wizard):
+    'Export Work Project Financials'
+    __name__ = 'work.project.export_financials'
+    start = StateView('work.project.export_financials.start',
+        'work_project.project_export_financials_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateReport('work.project.financials')
+
+    def do_export(self, action):
+        if self.start.selected:
+            return action, {
+                'ids': Transaction().context.get('active_ids', []),
+                }
+        return action, {
+            'ids': [],
+            'domain': self.start.get_domain(),
+            }
+
+
+class ProjectFinancialsReport(Report):
+    __name__ = 'work.project.financials'
+
+    @classmethod
+    def execute(cls, ids, data):
+        '''
+        Returns the financial figures of the projects of ids, or matching the
+        domain of data, as CSV.
+        The rows are written by chunks into a temporary file so only one
+        chunk of projects is kept in memory.
+        '''
+        pool = Pool()
+        Project = pool.get('work.project')
+        ActionReport = pool.get('ir.action.report')
+        cls.check_access()
+
+        action_report, = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ])
+        if data.get('domain') is not None:
+            projects = Project.search(data['domain'], order=[('code', 'ASC')])
+        else:
+            projects = Project.browse(ids)
+        with tempfile.TemporaryFile() as file_:
+            Project.write_financials_csv(projects, file_)
+            file_.seek(0)
+            content = bytearray(file_.read())
+        return ('csv', content, action_report.direct_print,
+            action_report.name)
 
 
 class Sale:
     __name__ = 'sale.sale'
-    project = fields.Many2One('work.project', 'Project', domain=[
+    project = fields.Many2One('work.project', 'Project', select=True,
+        domain=[
             ('party', '=', Eval('party')),
             ],
         states={
@@ -388,11 +1521,289 @@ class Sale:
             },
         depends=['party', 'state'])
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Partial index matching the sales aggregated by ProjectSaleLine
+        index_name = table.convert_name('%s_project_active_index'
+            % cls._table)
+        if index_name not in table._indexes:
+            cursor.execute('CREATE INDEX "%s" ON "%s" ("project") '
+                'WHERE "project" IS NOT NULL AND "state" NOT IN (%s)' % (
+                    index_name, cls._table,
+                    ', '.join("'%s'" % s for s in _SALE_EXCLUDED_STATES)))
+
+    @classmethod
+    def _get_work_projects(cls, sales):
+        'Returns the ids of the projects of the sales'
+        return set(s.project.id for s in cls.browse([s.id for s in sales])
+            if s.project)
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Project = pool.get('work.project')
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        sales = super(Sale, cls).create(vlist)
+        projects = cls._get_work_projects(sales)
+        Project.update_shipment_state(projects)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)
+        return sales
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Project = pool.get('work.project')
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        SaleLine = pool.get('sale.line')
+        actions = iter(args)
+        all_sales = []
+        to_update = []
+        update_shipment_state = False
+        for sales, values in zip(actions, actions):
+            all_sales.extend(sales)
+            if 'project' in values:
+                to_update.extend(sales)
+            if 'project' in values or 'shipment_state' in values:
+                update_shipment_state = True
+        projects = cls._get_work_projects(all_sales)
+        super(Sale, cls).write(*args)
+        if to_update:
+            SaleLine._update_work_project(SaleLine.search([
+                        ('sale', 'in', [s.id for s in to_update]),
+                        ]))
+        projects |= cls._get_work_projects(all_sales)
+        if update_shipment_state:
+            Project.update_shipment_state(projects)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, sales):
+        pool = Pool()
+        Project = pool.get('work.project')
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        projects = cls._get_work_projects(sales)
+        super(Sale, cls).delete(sales)
+        Project.update_shipment_state(projects)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)
+
+    @classmethod
+    def _get_invoiced_lines_query(cls):
+        '''
+        Returns a query with the quantity and unit price of every invoice line
+        originated by a sale line, with its sale, project and currency.
+        Cancelled invoices are ignored and credit notes, which have negative
+        quantities, are deducted.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        sale = cls.__table__()
+        sale_line = SaleLine.__table__()
+        invoice = Invoice.__table__()
+        invoice_line = InvoiceLine.__table__()
+
+        return invoice_line.join(invoice,
+            condition=invoice.id == invoice_line.invoice
+            ).join(sale_line, condition=invoice_line.origin == Concat(
+                    SaleLine.__name__ + ',', sale_line.id)
+            ).join(sale, condition=sale.id == sale_line.sale
+            ).select(sale.id.as_('sale'), sale.project.as_('project'),
+                invoice.currency.as_('currency'),
+                invoice.invoice_date.as_('date'),
+                invoice_line.quantity, invoice_line.unit_price,
+                where=(invoice_line.type == 'line')
+                & (invoice.state != 'cancel'))
+
+    @classmethod
+    def _sum_invoiced_amounts(cls, ids, key):
+        '''
+        Returns a dictionary with the invoiced amount grouped by key, 'sale'
+        or 'project', for the ids.
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        query = cls._get_invoiced_lines_query()
+        column = getattr(query, key)
+
+        amounts = dict((i, Decimal('0.00')) for i in ids)
+        currencies = {}
+        for sub_ids in grouped_slice(ids):
+            # Lines are rounded one by one as on the invoice so the identical
+            # lines are grouped
+            cursor.execute(*query.select(column, query.currency,
+                    query.quantity, query.unit_price, Count(Literal('*')),
+                    where=reduce_ids(column, sub_ids),
+                    group_by=[column, query.currency, query.quantity,
+                        query.unit_price]))
+            for id_, currency_id, quantity, unit_price, count in (
+                    cursor.fetchall()):
+                if currency_id not in currencies:
+                    currencies[currency_id] = Currency(currency_id)
+                amounts[id_] += _round_line(currencies[currency_id],
+                    quantity, unit_price, count)
+        return amounts
+
+    @classmethod
+    def get_invoiced_amounts(cls, sales):
+        'Returns a dictionary with the untaxed amount invoiced of each sale'
+        return cls._sum_invoiced_amounts([s.id for s in sales], 'sale')
+
+    @classmethod
+    def get_amounts_to_invoice(cls, sales):
+        'Returns a dictionary with the untaxed amount to invoice of each sale'
+        untaxed_amounts = cls.get_amount(sales, ['untaxed_amount'])[
+            'untaxed_amount']
+        invoiced_amounts = cls.get_invoiced_amounts(sales)
+        return dict((s.id, untaxed_amounts[s.id] - invoiced_amounts[s.id])
+            for s in sales)
+
+    @profile
     def invoiced_amount(self):
-        amount = Decimal('0.00')
-        for invoice in self.invoices:
-            amount += invoice.untaxed_amount
-        return amount
+        return self.get_invoiced_amounts([self])[self.id]
 
+    @profile
     def amount_to_invoice(self):
-        return self.untaxed_amount - self.invoiced_amount()
+        return self.get_amounts_to_invoice([self])[self.id]
+
+
+class SaleLine:
+    __name__ = 'sale.line'
+    work_project = fields.Many2One('work.project', 'Work Project',
+        readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        sale = Sale.__table__()
+
+        super(SaleLine, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['sale', 'type'], 'add')
+
+        # Fill the project of the lines created before the column
+        cursor.execute(*sql_table.update([sql_table.work_project],
+                [sale.select(sale.project, where=sale.id == sql_table.sale)],
+                where=(sql_table.work_project == Null)
+                & sql_table.sale.in_(sale.select(sale.id,
+                        where=sale.project != Null))))
+
+    @classmethod
+    def _update_work_project(cls, lines):
+        '''
+        Store the project of the sale on the lines and on the moves and
+        invoice lines they originated.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Move = pool.get('stock.move')
+        InvoiceLine = pool.get('account.invoice.line')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        sale = Sale.__table__()
+
+        line_ids = [l.id for l in lines]
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.update([table.work_project],
+                    [sale.select(sale.project, where=sale.id == table.sale)],
+                    where=reduce_ids(table.id, sub_ids)))
+        for Model in [Move, InvoiceLine]:
+            cls._update_origin_work_project(Model, line_ids=line_ids)
+
+    @classmethod
+    def _update_origin_work_project(cls, Model, ids=None, line_ids=None):
+        '''
+        Store the project of the sale on the records of Model originated by
+        a sale line.
+        Only the records of ids or those originated by the lines of line_ids
+        are updated when given, otherwise those without project.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        cursor = Transaction().connection.cursor()
+        table = Model.__table__()
+        line = cls.__table__()
+        sale = Sale.__table__()
+
+        project = line.join(sale, condition=sale.id == line.sale).select(
+            sale.project,
+            where=Concat(cls.__name__ + ',', line.id) == table.origin)
+        where = Like(table.origin, cls.__name__ + ',%')
+        if ids is not None:
+            wheres = [reduce_ids(table.id, sub_ids)
+                for sub_ids in grouped_slice(ids)]
+        elif line_ids is not None:
+            wheres = [table.origin.in_(
+                    ['%s,%s' % (cls.__name__, i) for i in sub_ids])
+                for sub_ids in grouped_slice(line_ids)]
+        else:
+            wheres = [table.work_project == Null]
+        for sub_where in wheres:
+            cursor.execute(*table.update([table.work_project], [project],
+                    where=where & sub_where))
+
+    @classmethod
+    def _get_work_projects(cls, lines):
+        'Returns the ids of the projects of the sale lines'
+        return set(l.sale.project.id
+            for l in cls.browse([l.id for l in lines])
+            if l.sale and l.sale.project)
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        lines = super(SaleLine, cls).create(vlist)
+        cls._update_work_project(lines)
+        projects = cls._get_work_projects(lines)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        actions = iter(args)
+        all_lines = []
+        to_update = []
+        for lines, values in zip(actions, actions):
+            all_lines.extend(lines)
+            if 'sale' in values:
+                to_update.extend(lines)
+        projects = cls._get_work_projects(all_lines)
+        super(SaleLine, cls).write(*args)
+        cls._update_work_project(to_update)
+        projects |= cls._get_work_projects(all_lines)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        ProjectSaleLine = pool.get('work.project.sale.line')
+        Summary = pool.get('work.project.summary')
+        projects = cls._get_work_projects(lines)
+        super(SaleLine, cls).delete(lines)
+        ProjectSaleLine.update(projects)
+        Summary.refresh(projects)